@@ -6,8 +6,8 @@ from .smir import SMIRDataset
 
 
 class BBCMaidaValeIR(SMIRDataset):
-    def __init__(self, path):
-        super().__init__(path)
+    def __init__(self, path, index=None):
+        super().__init__(path, index)
         self.n_channels = 32
 
     def generate_ir_paths(self, room, setup, mic, mic_pos, src_pos, src_dir, **kwargs):
@@ -37,8 +37,7 @@ class BBCMaidaValeIR(SMIRDataset):
 
     @staticmethod
     def _get_metadata(files):
-        df = pd.DataFrame({'filename': files}) \
-            .apply(lambda x: x.filename.stem, axis=1) \
+        df = pd.Series([f.stem for f in files]) \
             .str.split('_', expand=True) \
             .drop([3, 5, 8, 9], axis='columns') \
             .drop_duplicates() \
@@ -1,24 +1,56 @@
+import hashlib
+import os
 from pathlib import Path
 
 import numpy as np
+import pandas as pd
+
+from features.utils import CacheMemory
+
+# Version of the cached index, to be bumped whenever metadata parsing changes
+INDEX_VERSION = 3
+
+# Dataset indices are cached apart from operators, outside the package, so that
+# they are cached whether or not operator banks are given, see set_index_cache_dir
+index_memory = CacheMemory(str(Path.home() / ".cache" / "sma_processing"))
 
 
 class SMIRDataset:
-    def __init__(self, path):
-        self.path = Path(path)
-        self.files = list(self.path.glob("**/*.wav"))
+    file_pattern = "**/*.wav"
 
-        self.metadata = self._get_metadata(self.files)
+    def __init__(self, path, index=None):
+        """
+        Parameters
+        ----------
+        path : PathLike
+            Directory of the dataset
+        index : Tuple[List[Path], pd.DataFrame], optional
+            Files and metadata of the dataset, e.g. `index` of an instance built
+            by the parent process, by default listed or loaded from the index cache
+        """
+        self.path = Path(path)
+        if index is None:
+            index = _build_index(type(self), self.path, _index_stamp(self.path), INDEX_VERSION)
+        self.files, self.metadata = index
         self.room = self.metadata['room'].unique()[0]
 
         self.src_coords = self._get_coords(self.room, 'src')
         self.mic_coords = self._get_coords(self.room, 'mic')
         self.n_channels = None
 
+        # (n_src x n_mic) distances, and their lookup table by positions
+        self.distances = pd.DataFrame(
+            np.linalg.norm(
+                self.src_coords.to_numpy()[:, None] - self.mic_coords.to_numpy()[None], axis=-1),
+            index=self.src_coords.index, columns=self.mic_coords.index)
+        self._distances = self.distances.stack().to_dict()
+
+    @property
+    def index(self):
+        return self.files, self.metadata
+
     def get_distance(self, src_pos, mic_pos):
-        coord_0 = np.array(self.src_coords.loc[src_pos])
-        coord_1 = np.array(self.mic_coords.loc[mic_pos])
-        return np.linalg.norm(coord_0 - coord_1)  # type: ignore
+        return self._distances[src_pos, mic_pos]
 
     def generate_ir_paths(self, **kwargs):
         raise NotImplementedError
@@ -41,3 +73,33 @@ class SMIRDataset:
     @staticmethod
     def _get_coords(room, type):
         raise NotImplementedError
+
+
+def set_index_cache_dir(location):
+    """
+    Moves the cache of dataset indices to a directory, or disables it if None
+    """
+    index_memory.location = None if location is None else str(location)
+
+
+def _index_stamp(path):
+    """
+    Digest of the paths and modification times of all dataset directories, which
+    change whenever files are added, removed or renamed at any depth. Files are
+    not stat'ed one by one, the index only depends on their names.
+    """
+    digest = hashlib.sha1()
+    for root, dirs, _ in os.walk(path):
+        dirs.sort()
+        digest.update(f"{root}\t{os.stat(root).st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+@index_memory.cache
+def _build_index(cls, path, stamp, version):
+    """
+    Lists the impulse response files of a dataset and parses their metadata,
+    cached until `stamp` or `version` changes
+    """
+    files = sorted(path.glob(cls.file_pattern))
+    return files, cls._get_metadata(files)
@@ -7,15 +7,10 @@ from .smir import SMIRDataset
 
 
 class SPARGAir(SMIRDataset):
-    def __init__(self, path):
-        self.path = Path(path)
-        self.files = list(self.path.glob("**/IR*.wav"))
+    file_pattern = "**/IR*.wav"
 
-        self.metadata = self._get_metadata(self.files)
-        self.room = 'ii-s05'
-
-        self.src_coords = self._get_coords(self.room, 'src')
-        self.mic_coords = self._get_coords(self.room, 'mic')
+    def __init__(self, path, index=None):
+        super().__init__(path, index)
         self.n_channels = 32
 
     def generate_ir_paths(self, src_pos, mic='em32', **kwargs):
@@ -51,13 +46,9 @@ class SPARGAir(SMIRDataset):
 
     @staticmethod
     def _get_metadata(files):
-        df = pd.DataFrame({'fpath': files}) \
-            .apply(
-                lambda x: x.fpath.parts[-3:-1], 
-                axis='columns', result_type='expand') \
+        df = pd.DataFrame([f.parts[-3:-1] for f in files], columns=['mic', 'src_pos']) \
             .drop_duplicates() \
             .reset_index(drop=True)
-        df.columns = ['mic', 'src_pos']  # type: ignore
         df['mic_pos'] = '332'
         df['room'] = 'ii-s05'
         df['src_dir'] = 'D'
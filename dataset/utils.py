@@ -1,10 +1,253 @@
+from collections import OrderedDict
+
 import numpy as np
-from scipy.signal import fftconvolve
+from scipy.fft import irfft, next_fast_len, rfft
 
-from utils import wavread
+from utils import read_channels, wav_info, wavread
+from utils.acoustics import truncation_point
 
 
-def emulate_scene(sig_path, gain, ir_paths):
+class IRCache:
+    """
+    Least-recently-used cache of multichannel impulse responses, keyed by their
+    paths, together with their spectra at the overlap-add lengths asked for, which
+    only depend on the impulse responses and so are shared by all sources.
+
+    Impulse responses can also be cached in transformed forms (e.g. encoded into
+    the spherical harmonic domain), by registering a function that maps the
+    (n_channels x n_taps) impulse responses to the transformed ones under a tag
+    in `encoders`, and asking for that tag.
+
+    Impulse responses can be truncated when loaded, dropping their tails below an
+    energy threshold (see `utils.acoustics.truncation_point`). Convolutions stay
+    centred as with the full impulse responses, see `start`.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Memory budget for the cached arrays, by default 1 GiB. Least recently
+        used scenarios are evicted when it is exceeded.
+    trim_db : float, optional
+        Truncation threshold in dB, by default impulse responses are not truncated
+    trim_kind : str, optional
+        Truncation criterion, 'energy' or 'direct', by default 'energy'
+    """
+
+    def __init__(self, max_bytes=2**30, trim_db=None, trim_kind='energy'):
+        self.max_bytes = max_bytes
+        self.trim_db = trim_db
+        self.trim_kind = trim_kind
+        self.nbytes = 0
+        self.encoders = {}
+        self._entries = OrderedDict()
+
+    def irs(self, ir_paths, tag=None):
+        """
+        Impulse responses as (n_channels x n_taps), in the order of `ir_paths`
+        """
+        return self._entry(ir_paths, tag)['irs']
+
+    def spectra(self, ir_paths, n_fft, tag=None):
+        """
+        Real FFTs of the impulse responses at length `n_fft`, (n_channels x n_fft // 2 + 1)
+        """
+        entry = self._entry(ir_paths, tag)
+        if n_fft not in entry['spectra']:
+            H = rfft(entry['irs'], n_fft, axis=-1)
+            if H.nbytes > self.max_bytes:
+                return H  # too large to be worth keeping
+
+            entry['spectra'][n_fft] = H
+            self.nbytes += H.nbytes
+            self._evict(keep=self._key(ir_paths, tag))
+        return entry['spectra'][n_fft]
+
+    def start(self, ir_paths, tag=None):
+        """
+        First sample of the full convolution output that 'same' mode keeps, as for
+        the impulse responses before truncation
+        """
+        entry = self._entry(ir_paths, tag)
+        return (entry['irs'].shape[-1] - 1) // 2 + entry['shift']
+
+    def truncation(self, ir_paths):
+        """
+        Truncation of the impulse responses, as a dict of their original number
+        of taps, the number kept and the largest residual energy in dB, or None
+        if they are not truncated
+        """
+        return self._entry(ir_paths).get('truncation')
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def _entry(self, ir_paths, tag=None):
+        key = self._key(ir_paths, tag)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        if tag is None:
+            entry = self._load(ir_paths)
+        else:
+            base = self._entry(ir_paths)
+            entry = dict(irs=self.encoders[tag](base['irs']), spectra={}, shift=base['shift'])
+
+        self._entries[key] = entry
+        self.nbytes += entry['irs'].nbytes
+        self._evict(keep=key)
+        return entry
+
+    def _load(self, ir_paths):
+        irs = read_channels(ir_paths)
+
+        # Channels shorter than the longest are delayed, so that all of them are
+        # centred by `start` as by 'same' mode on their own length
+        for ch, path in enumerate(ir_paths):
+            delay = (irs.shape[-1] - 1) // 2 - (wav_info(path)['n_samples'] - 1) // 2
+            irs[ch] = np.roll(irs[ch], delay)  # only trailing zeros wrap around
+
+        entry = dict(irs=irs, spectra={}, shift=0)
+        if self.trim_db is None:
+            return entry
+
+        n_taps, residual_db = truncation_point(irs, self.trim_db, self.trim_kind)
+        entry['irs'] = np.ascontiguousarray(irs[:, :n_taps])
+        entry['shift'] = (irs.shape[-1] - 1) // 2 - (n_taps - 1) // 2
+        entry['truncation'] = dict(n_taps=irs.shape[-1], trimmed=n_taps, residual_db=residual_db)
+        return entry
+
+    def _evict(self, keep):
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            key, entry = next(iter(self._entries.items()))
+            if key == keep:
+                self._entries.move_to_end(key)
+                continue
+            del self._entries[key]
+            self.nbytes -= entry['irs'].nbytes + \
+                sum(H.nbytes for H in entry['spectra'].values())
+
+    @staticmethod
+    def _key(ir_paths, tag=None):
+        return (tag, tuple(str(f) for f in ir_paths))
+
+
+ir_cache = IRCache()
+
+
+class Source:
+    """
+    Single-channel source signal together with its spectrum, which is computed
+    once per FFT length and then shared among all scenarios it is emulated in.
+    Only the most recent spectrum is kept, e.g. scenarios of truncated impulse
+    responses of different lengths each replace it rather than adding up.
+
+    Parameters
+    ----------
+    sig : NDArray
+        Single-channel signal.
+    """
+
+    def __init__(self, sig):
+        self.sig = sig
+        self._spectra = {}
+
+    def __len__(self):
+        return len(self.sig)
+
+    def spectrum(self, n_fft, block=None):
+        """
+        Real FFT of the signal at length `n_fft`, or of its consecutive blocks of
+        `block` samples as (n_blocks x n_fft // 2 + 1) if given
+        """
+        key = (n_fft, block)
+        if key not in self._spectra:
+            sig = self.sig
+            if block is not None:
+                n_blocks = -(-len(sig) // block)
+                sig = np.pad(sig, (0, n_blocks * block - len(sig))).reshape(n_blocks, block)
+            self._spectra = {key: rfft(sig, n_fft, axis=-1)}
+        return self._spectra[key]
+
+    @classmethod
+    def from_file(cls, path):
+        sig, _ = wavread(path)
+        return cls(sig)
+
+
+def convolve_scene(sig, ir_paths, gain=1, cache=None, method='auto', block_size=2**26, tag=None):
+    """
+    Convolve a single-channel signal with all impulse responses of a scenario at once.
+
+    The signal is transformed only once, and multiplied with the stacked spectra of
+    the impulse responses in a single vectorised step. Output is centred as in
+    `fftconvolve(gain * sig, ir, mode='same')` for each impulse response.
+
+    Parameters
+    ----------
+    sig : NDArray or Source
+        Single-channel signal. Transforms of a `Source` are reused across calls.
+    ir_paths : List[PathLike]
+        List of paths to the impulse responses.
+    gain : float or int, optional
+        Gain, by default 1
+    cache : IRCache, optional
+        Cache of impulse responses and their spectra, by default the module's `ir_cache`
+    method : str, optional
+        'fft' for a single full-length FFT, 'oa' for block overlap-add, or 'auto' to
+        use overlap-add for signals much longer than the impulse responses.
+    block_size : int, optional
+        Number of bytes of the per-block intermediate results of overlap-add,
+        by default 64 MiB.
+    tag : Hashable, optional
+        Tag of the transformed impulse responses registered in the cache, by
+        default the impulse responses themselves.
+
+    Returns
+    -------
+    NDArray
+        Convolved signals as (n_channels x len(sig)), in the order given in `ir_paths`.
+    """
+    assert method in ['auto', 'fft', 'oa'], f"Invalid method: {method}"
+    cache = cache or ir_cache
+    source = sig if isinstance(sig, Source) else Source(sig)
+
+    n_samples = len(source)
+    n_channels, n_taps = cache.irs(ir_paths, tag).shape
+    start = cache.start(ir_paths, tag)  # centred as in 'same' mode
+
+    # Overlap-add blocks only depend on the IR length, so their spectra are reused
+    n_fft = next_fast_len(4 * n_taps, real=True)
+    if method == 'auto':
+        method = 'oa' if n_samples > 4 * n_fft else 'fft'
+
+    if method == 'fft':
+        # Full-length spectra depend on the source length, so they are not cached
+        n_fft = next_fast_len(max(n_samples + n_taps - 1, start + n_samples), real=True)
+        H = rfft(cache.irs(ir_paths, tag), n_fft, axis=-1)
+        out = irfft(gain * source.spectrum(n_fft) * H, n_fft, axis=-1)
+        return out[:, start:start + n_samples]
+
+    # Block overlap-add, where each block of L samples has a tail of n_taps - 1 <= L
+    L = n_fft - n_taps + 1
+    n_blocks = -(-n_samples // L)
+    H = cache.spectra(ir_paths, n_fft, tag)[:, None, :]
+
+    X = source.spectrum(n_fft, block=L)
+
+    out = np.zeros((n_channels, max(n_blocks + 1, -(-(start + n_samples) // L)), L))
+    step = max(1, block_size // (n_channels * n_fft * 8))
+    for b in range(0, n_blocks, step):
+        Y = irfft(gain * X[b:b + step] * H, n_fft, axis=-1)
+        g = Y.shape[1]
+        out[:, b:b + g] += Y[..., :L]
+        out[:, b + 1:b + g + 1, :n_taps - 1] += Y[..., L:]
+
+    return out.reshape(n_channels, -1)[:, start:start + n_samples]
+
+
+def emulate_scene(sig_path, gain, ir_paths, cache=None, tag=None):
     """
     Emulate an acoustic scene for a sound.
 
@@ -13,45 +256,136 @@ def emulate_scene(sig_path, gain, ir_paths):
 
     Parameters
     ----------
-    sig_path : str or PathLike
-        Path to the anechoic sound file.
+    sig_path : str, PathLike or Source
+        Path to the anechoic sound file, or the already loaded source.
     gain : float or int
         Gain.
     ir_paths : List[PathLike]
         List of paths to the impulse responses.
+    cache : IRCache, optional
+        Cache of impulse responses and their spectra, by default the module's `ir_cache`
+    tag : Hashable, optional
+        Tag of the transformed impulse responses registered in the cache, e.g. for
+        emulating directly in the spherical harmonic domain.
 
     Returns
     -------
     NDArray
         Emulation signals, in the order given in `ir_paths`.
     """
-
     # We expect ir_paths to be ACN channel sorted
-    sig, _ = wavread(sig_path)
-    irs = [wavread(f)[0] for f in ir_paths]
+    source = sig_path if isinstance(sig_path, Source) else Source.from_file(sig_path)
+    return convolve_scene(source, ir_paths, gain, cache, tag=tag)
+
+
+def convolve_window(sig_path, ir_paths, samples, gain=1, cache=None, block_size=2**26, tag=None, out=None):
+    """
+    Convolve a single-channel signal with all impulse responses of a scenario,
+    computing only a window of the output.
 
-    out = [fftconvolve(gain * sig, ir, mode='same') for ir in irs]
-    return np.stack(out, axis=0)
+    Output is the window of `convolve_scene`, computed by block overlap-add (i.e.
+    convolution partitioned over the input) of only the input samples it depends
+    on, which are the only ones read if the signal is given as a file.
 
+    Parameters
+    ----------
+    sig_path : str, PathLike, Source or NDArray
+        Path to the anechoic sound file, or the already loaded signal.
+    ir_paths : List[PathLike]
+        List of paths to the impulse responses.
+    samples : Tuple[int, int]
+        Start and stop samples of the output window.
+    gain : float or int, optional
+        Gain, by default 1
+    cache : IRCache, optional
+        Cache of impulse responses and their spectra, by default the module's `ir_cache`
+    block_size : int, optional
+        Number of bytes of the per-block intermediate results, by default 64 MiB.
+    tag : Hashable, optional
+        Tag of the transformed impulse responses registered in the cache.
+    out : NDArray, optional
+        (n_channels x stop - start) array the output is added to, by default zeros.
 
-def compose_scene(sig_path_list, ir_paths_list, gain=1, samples=(0, 48000)):
+    Returns
+    -------
+    NDArray
+        Convolved signals as (n_channels x stop - start), in the order given in `ir_paths`.
+    """
+    cache = cache or ir_cache
+    n_channels, n_taps = cache.irs(ir_paths, tag).shape
+    start = cache.start(ir_paths, tag)  # centred as in 'same' mode
+
+    if out is None:
+        out = np.zeros((n_channels, samples[1] - samples[0]))
+
+    # Input samples the window depends on, zero outside the signal
+    if isinstance(sig_path, (Source, np.ndarray)):
+        sig = sig_path.sig if isinstance(sig_path, Source) else sig_path
+        n_samples = len(sig)
+    else:
+        sig, n_samples = None, wav_info(sig_path)['n_samples']
+
+    # 'same' mode output is as long as the signal, and zero outside of it
+    begin, stop = max(samples[0], 0), min(samples[1], n_samples)
+    if stop <= begin:
+        return out
+    window = out[:, begin - samples[0]:]
+
+    first = begin + start - (n_taps - 1)
+    last = stop + start
+    if sig is None:
+        x, _ = wavread(sig_path, start=max(first, 0), stop=last)
+    else:
+        x = sig[max(first, 0):last]
+    x = np.pad(x, (max(-first, 0), 0))
+
+    # Block overlap-add, where each block of L samples has a tail of n_taps - 1 <= L
+    n_fft = next_fast_len(4 * n_taps, real=True)
+    L = n_fft - n_taps + 1
+    n_blocks = -(-len(x) // L)
+    H = cache.spectra(ir_paths, n_fft, tag)[:, None, :]
+
+    # Full convolution of x, of which only samples n_taps - 1 .. are valid
+    n_valid = stop - begin
+    offset = n_taps - 1
+    step = max(1, block_size // (n_channels * n_fft * 8))
+    for b in range(0, n_blocks, step):
+        blocks = x[b * L:(b + step) * L]
+        blocks = np.pad(blocks, (0, -len(blocks) % L)).reshape(-1, L)
+        Y = irfft(gain * rfft(blocks, n_fft, axis=-1) * H, n_fft, axis=-1)
+
+        for i in range(Y.shape[1]):
+            # samples of block b + i are at b * L + i * L + 0 .. n_fft
+            lo = (b + i) * L - offset
+            src = slice(max(-lo, 0), min(n_fft, n_valid - lo))
+            if src.stop > src.start:
+                window[:, lo + src.start:lo + src.stop] += Y[:, i, src]
+    return out
+
+
+def compose_scene(sig_path_list, ir_paths_list, gain=1, samples=(0, 48000), cache=None):
     """
     Composes multiple room acoustics emulations, generally for emulating
     simultaneous sources in an acoustic environment.
 
+    Only the requested window is computed, from the samples of each source it
+    depends on, and mixed into a single output buffer.
+
     Parameters
     ----------
     sig_path_list : List[PathLike]
-        List of paths to the anechoic sound files.
+        List of paths to the anechoic sound files, or already loaded sources.
     ir_paths_list : List[List[PathLike]]
         List of list of paths to the impulse responses. Expected to be in order.
         Inner list represents the channels, and outer list the source positions.
         Each list is associated with the anechoic sound given in `sig_path_list`
         at the same index.
-    gain : int, optional
-        Gain, by default 1
+    gain : float or List[float], optional
+        Gain, or gains of each source, by default 1
     samples : tuple, optional
         Start and stop samples, by default (0, 48000). Mind the sampling rate.
+    cache : IRCache, optional
+        Cache of impulse responses and their spectra, by default the module's `ir_cache`
 
     Returns
     -------
@@ -69,6 +403,7 @@ def compose_scene(sig_path_list, ir_paths_list, gain=1, samples=(0, 48000)):
     # Open a blank canvas
     sgo = np.zeros((n_channels, samples[1] - samples[0]))
 
-    for sig_path, ir_paths in zip(sig_path_list, ir_paths_list):
-        sgo += emulate_scene(sig_path, gain, ir_paths)
+    gains = np.broadcast_to(gain, len(sig_path_list))
+    for sig_path, ir_paths, g in zip(sig_path_list, ir_paths_list, gains):
+        convolve_window(sig_path, ir_paths, samples, g, cache, out=sgo)
     return sgo
@@ -1,17 +1,25 @@
+import json
+import os
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
 
 import numpy as np
+from hydra.utils import to_absolute_path
 
 from dataset import SMIRDataset
-from dataset.utils import emulate_scene
-from features import rent, shd, srf
+from dataset.utils import IRCache, Source, convolve_window, emulate_scene
+from features import operators, rent, shd, srf
 from microphone import microphones
+from utils.ledger import JobLedger
+from utils.store import FeatureStore
 
 from omegaconf import OmegaConf, open_dict
 
 
 class Extractor:
-    def __init__(self, params: OmegaConf, dataset: SMIRDataset) -> None:
+    def __init__(self, params: OmegaConf, dataset: SMIRDataset, ir_cache: IRCache = None,
+                 store: FeatureStore = None, operator_banks=None) -> None:
         """
         Feature extractor via emulation featuring anechoic sounds and 
         multichannel impulse response dataset.
@@ -22,9 +30,21 @@ class Extractor:
             Parameters for feature extraction
         dataset : SMIRDataset
             Spherical microphone impulse response dataset
+        ir_cache : IRCache, optional
+            Cache of impulse responses shared among jobs, by default a new 1 GiB cache
+        store : FeatureStore, optional
+            Store the results are saved to, by default one .npy file per job
+        operator_banks : PathLike, optional
+            Directory of operator banks built with `features.operators`, relative
+            to the original working directory, by default operators are computed
+            and cached on the fly
         """
         self.params = self._load_params(params)
         self.dataset = dataset
+        self.ir_cache = ir_cache or IRCache()
+        self.store = store
+        self.operator_banks = None if operator_banks is None else to_absolute_path(operator_banks)
+        self.operators = {}  # by microphone
 
     def job(self, anechoic_path, scenario, save=True):
         """
@@ -49,19 +69,92 @@ class Extractor:
             RENT and SHD matrices are returned if 
             `output_shd` is enabled and `save` is disabled.
         """
-        y = self.load_signal(anechoic_path, scenario)
+        return self.batch_job(anechoic_path, [scenario], save=save)[0]
 
-        res = rent_pipe(
-            y,
-            **self.params,
-            mic=microphones[scenario['mic']]
-        )
+    def batch_job(self, anechoic_path, scenarios, save=True):
+        """
+        RENT extraction jobs of an anechoic sound over multiple scenarios, see `iter_jobs`
+
+        Returns
+        -------
+        List[None or NDArray]
+            Results of the jobs, in the order of `scenarios`
+        """
+        return list(self.iter_jobs(anechoic_path, scenarios, save=save))
+
+    def iter_jobs(self, anechoic_path, scenarios, save=True, source=None):
+        """
+        RENT extraction jobs of an anechoic sound over multiple scenarios
+
+        The anechoic sound is loaded and transformed only once, and shared among
+        all scenarios.
+
+        Parameters
+        ----------
+        anechoic_path : Union[str, bytes, PathLike]
+            Path for anechoic sound file path
+        scenarios : List[Dict]
+            Dictionaries describing the emulation scenarios
+        save : bool, optional
+            Results are saved when true, returned when false, by default True
+        source : Source, optional
+            Already loaded anechoic sound, by default loaded from `anechoic_path`
 
-        if save:
-            return self.save_result(res, anechoic_path, scenario)
-        return res
+        Yields
+        ------
+        None or NDArray
+            Result of each job as in `job`, as soon as it is done
+        """
+        if source is None:
+            source = Source.from_file(anechoic_path)
+
+        for scenario in scenarios:
+            kwargs = dict(
+                self.params,
+                mic=microphones[scenario['mic']],
+                operators=self.load_operators(scenario['mic'])
+            )
+
+            if not self.params.get('block_frames'):
+                res = rent_pipe(self.load_signal(source, scenario), **kwargs)
+            else:
+                # Emulated in windows as well, only a block is resident at a time
+                read = partial(self.load_window, source, scenario)
+                if save:
+                    # and its RENT frames are written to the result as they are computed
+                    shape = rent_shape(len(source), **self.params)
+                    with self.result_writer(shape, anechoic_path, scenario) as out:
+                        rent_pipe_blocks(read, len(source), out=out, **kwargs)
+                        del out  # unmapped before the result is completed
+                    yield None
+                    continue
+                res = rent_pipe_blocks(read, len(source), **kwargs)
+
+            if save:
+                yield self.save_result(res, anechoic_path, scenario)
+            else:
+                yield res
 
     def load_signal(self, sig_path, scenario):
+        gain, ir_paths, tag = self._scene(scenario)
+        sig = emulate_scene(sig_path, gain, ir_paths, cache=self.ir_cache, tag=tag)
+        return sig
+
+    def load_window(self, source, scenario, start, stop):
+        """
+        Samples start..stop of the emulation of a scenario, zero outside the signal
+        """
+        gain, ir_paths, tag = self._scene(scenario)
+        n_channels = self.ir_cache.irs(ir_paths, tag).shape[0]
+
+        sig = np.zeros((n_channels, stop - start))
+        lo, hi = max(start, 0), min(stop, len(source))
+        if hi > lo:
+            convolve_window(source, ir_paths, (lo, hi), gain, self.ir_cache, tag=tag,
+                            out=sig[:, lo - start:hi - start])
+        return sig
+
+    def _scene(self, scenario):
         # NOTE: Should this function belong to the SMIRDataset class?
         # Calculate gain
         mic_pos = scenario['mic_pos']
@@ -71,12 +164,97 @@ class Extractor:
         # Generate IR paths
         ir_paths = self.dataset.generate_ir_paths(**scenario)
 
-        sig = emulate_scene(sig_path, gain, ir_paths)
-        return sig
+        tag = self._ir_tag(scenario['mic'])
+        return gain, ir_paths, tag
+
+    def load_operators(self, mic, build=False):
+        """
+        Operators of the microphone, memory-mapped from its operator bank if operator
+        banks are given, computed if `build` is set, otherwise None
+        """
+        if mic in self.operators:
+            return self.operators[mic]
+
+        p = self.params
+        config = dict(fs=p['fs'], n_fft=p['n_fft'], fimin=p['fimin'], fimax=p['fimax'],
+                      j_nu=p['j_nu'], n_shd=p['n_shd'], n_pix=p['n_pix'])
+        if self.operator_banks is not None:
+            path = Path(self.operator_banks) / operators.bank_name(mic, **config)
+            self.operators[mic] = operators.load_operators(path, config=dict(mic=mic, **config))
+        elif build:
+            self.operators[mic] = operators.build_operators(
+                microphones[mic], **config, dictionary=not p.get('sh_rent', False))
+        return self.operators.get(mic)
+
+    def _ir_tag(self, mic):
+        """
+        Registers the SH-domain impulse response encoder of the microphone in the
+        IR cache if emulations are done in SH domain, and returns its tag
+        """
+        p = self.params
+        if not p.get('sh_domain', False):
+            return None
+
+        tag = ('sh', mic)
+        if tag not in self.ir_cache.encoders:
+            df = p['fs'] / p['n_fft']  # STFT bin width, Hann main lobe is 4 bins wide
+            self.ir_cache.encoders[tag] = partial(
+                shd.encode_irs,
+                mic=microphones[mic], fs=p['fs'], n_shd=p['n_shd'],
+                band=((p['fimin'] - 2) * df, (p['fimax'] + p['j_nu'] + 1) * df),
+                taper=2 * df, delay=p['n_fft'])
+        return tag
 
     def save_result(self, result, anechoic_path, scenario):
+        band = self.band_metadata()
+        if self.store is not None:
+            self.store.append(result, job=JobLedger.job_id(anechoic_path, scenario),
+                              audio=str(anechoic_path), **band, **scenario)
+            return
+
         save_folder = ""
-        self._save_npy(result, save_folder, anechoic_path, **scenario)
+        self._save_npy(result, save_folder, anechoic_path, band=band, **scenario)
+
+    @contextmanager
+    def result_writer(self, shape, anechoic_path, scenario):
+        """
+        Result of a job to be written incrementally, as a writable memory-mapped
+        array of `shape` in the store or in the .npy file of the job, which is
+        complete once the block exits
+
+        The .npy file is written under a temporary name, and takes its name only
+        after its sidecar is written, so that a crashed job leaves no result that
+        would be read as a full-band one.
+        """
+        band = self.band_metadata()
+        if self.store is not None:
+            with self.store.writer(shape, job=JobLedger.job_id(anechoic_path, scenario),
+                                   audio=str(anechoic_path), **band, **scenario) as out:
+                yield out
+            return
+
+        save_path = self._npy_path("", anechoic_path, **scenario)
+        save_path.parent.mkdir(parents=True, exist_ok=True)
+        part_path = save_path.with_name(save_path.name + ".part")
+        out = np.lib.format.open_memmap(part_path, mode='w+', dtype=np.float64, shape=shape)
+        yield out
+
+        out.flush()
+        del out  # unmapped once the caller has let go of it as well, before renaming
+        with open(save_path.with_suffix('.json'), 'w') as f:
+            json.dump(band, f)
+        os.replace(part_path, save_path)
+
+    def band_metadata(self):
+        """
+        Frequency indices covered by the results, recorded along with them
+
+        fi_offset is the frequency index of the first column, 0 for full-band
+        results, and band_start..band_stop are the analysed frequency indices.
+        """
+        p = self.params
+        return dict(fi_offset=0 if p.get('full_band', False) else p['fimin'],
+                    band_start=p['fimin'], band_stop=p['fimax'] + p['j_nu'])
 
     @staticmethod
     def _load_params(params: OmegaConf):
@@ -89,14 +267,22 @@ class Extractor:
         return p
 
     @staticmethod
-    def _save_npy(npy, save_folder, anechoic_path, mic_pos, src_pos, src_dir, **kwargs):
+    def _npy_path(save_folder, anechoic_path, mic_pos, src_pos, src_dir, **kwargs):
         # TODO: How to split all variables from here while anechoic filename contains "_"
         # Example output filename: OA-09_PA-19_W__mahler_vl1b_6
-        save_name = f"{mic_pos}_{src_pos}_{src_dir}__{anechoic_path.stem}.npy"
-        save_path = Path.cwd() / save_folder / save_name
+        save_name = f"{mic_pos}_{src_pos}_{src_dir}__{Path(anechoic_path).stem}.npy"
+        return Path.cwd() / save_folder / save_name
+
+    @classmethod
+    def _save_npy(cls, npy, save_folder, anechoic_path, band=None, **scenario):
+        save_path = cls._npy_path(save_folder, anechoic_path, **scenario)
 
         save_path.parent.mkdir(parents=True, exist_ok=True)
         np.save(save_path, npy)
+        if band is not None:
+            # sidecar read by utils.load.load_feature
+            with open(save_path.with_suffix('.json'), 'w') as f:
+                json.dump(band, f)
 
 
 def rent_pipe(
@@ -110,10 +296,88 @@ def rent_pipe(
     j_nu,
     mic,
     n_pix,  # srf
+    full_band=False,  # rent
+    sh_domain=False,
+    sh_rent=False,  # rent
+    operators=None,  # precomputed, see features.operators
+    frames=None,  # of y starting at sample offset, all by default
+    offset=0,
     **kwargs
 ):
-    Anm = shd.extract(y, fs, n_fft, olap, n_shd, fimin, fimax, j_nu, mic)
-    S = srf.extract(Anm, n_pix)
-    R = rent.extract(S, n_shd, fimin, fimax, j_nu)
+    ops = operators or {}
+
+    # Band-limited to fimin..fimax+j_nu from here on
+    Anm = shd.extract(y, fs, n_fft, olap, n_shd, fimin, fimax, j_nu, mic,
+                      encoded=sh_domain, encoder=ops.get('encoder'),
+                      frames=frames, offset=offset)
+    if sh_rent:
+        # Straight from the SHD coefficients, the SRF is never formed
+        return rent.extract_sh(Anm, n_shd, n_pix, fimin, fimax, j_nu,
+                               n_bins=n_fft // 2 if full_band else None,
+                               atoms=ops.get('sh_atoms'), gram=ops.get('sh_gram'),
+                               atom_norms=ops.get('atom_norms'))
+
+    S = srf.extract(Anm, n_pix, S=ops.get('srf'))
+    R = rent.extract(S, n_shd, fimin, fimax, j_nu,
+                     n_bins=n_fft // 2 if full_band else None,
+                     dictionary=ops.get('dictionary'), atom_norms=ops.get('atom_norms'))
 
     return R
+
+
+def rent_shape(n_samples, n_fft, olap, fimin, fimax, j_nu, full_band=False, **kwargs):
+    """
+    Shape of the RENT of a signal of `n_samples`, (n_frames x n_bins), see `rent_pipe`
+    """
+    n_frames = int(np.ceil(n_samples / (n_fft / olap)))
+    n_bins = n_fft // 2 if full_band else fimax + j_nu - fimin
+    return n_frames, n_bins
+
+
+def rent_pipe_blocks(read, n_samples, n_fft, olap, fimin, fimax, j_nu, block_frames=256,
+                     full_band=False, out=None, **kwargs):
+    """
+    RENT of a long signal, computed over blocks of frames so that memory is
+    bounded by the block size rather than the signal length
+
+    Each block reads only the samples its frames cover and goes through
+    `rent_pipe`, whose frames are independent of each other, so that results
+    agree with those of `rent_pipe` on the whole signal to floating-point
+    tolerance. They cannot be bit-identical in general: emulated samples of a
+    window come from FFTs of other lengths and partitions than those of the whole
+    signal (see `convolve_window`), and matrix products over the frames of a block
+    may be summed in another order by BLAS than over all frames.
+
+    Parameters
+    ----------
+    read : Callable[[int, int], NDArray]
+        Returns samples start..stop of the signal as (n_channels x stop - start),
+        zero outside the signal
+    n_samples : int
+        Length of the signal
+    block_frames : int, optional
+        Number of STFT frames per block, by default 256
+    out : NDArray, optional
+        (n_frames x n_bins) array the RENT frames are written to as they are
+        computed, e.g. a memory-mapped file
+    **kwargs
+        Parameters of `rent_pipe`
+
+    Returns
+    -------
+    NDArray
+        RENT as (n_frames x n_bins)
+    """
+    hop_size = n_fft / olap
+    n_frames, n_bins = rent_shape(n_samples, n_fft, olap, fimin, fimax, j_nu, full_band)
+    if out is None:
+        out = np.empty((n_frames, n_bins))
+    for f0 in range(0, n_frames, block_frames):
+        f1 = min(f0 + block_frames, n_frames)
+        start = int(f0 * hop_size) - n_fft // 2  # of the first frame, as in stft
+        stop = int((f1 - 1) * hop_size) - n_fft // 2 + n_fft
+
+        out[f0:f1] = rent_pipe(
+            read(start, stop), n_fft=n_fft, olap=olap, fimin=fimin, fimax=fimax, j_nu=j_nu,
+            full_band=full_band, frames=(f0, f1), offset=start, **kwargs)
+    return out
@@ -0,0 +1,57 @@
+import numpy as np
+
+try:
+    # scipy >= 1.15, where sph_harm is deprecated (and later removed)
+    from scipy.special import sph_harm_y
+
+    def _sph_harm(m, n, theta, phi):
+        return sph_harm_y(n, m, theta, phi)
+except ImportError:
+    from scipy.special import sph_harm
+
+    def _sph_harm(m, n, theta, phi):
+        return sph_harm(m, n, phi, theta)
+
+
+def acn_orders(n_shd):
+    '''
+    Returns degree and order arrays, n and m, of spherical harmonics up to
+    order N in ACN channel ordering, i.e. ACN = n^2 + n + m
+    '''
+    n = np.repeat(np.arange(n_shd + 1), 2 * np.arange(n_shd + 1) + 1)
+    m = np.arange((n_shd + 1)**2) - n * (n + 1)
+    return n, m
+
+
+def sph_harm_matrix(n_shd, theta, phi, kind='complex'):
+    '''
+    Evaluates all spherical harmonics up to order N on all given directions at once
+
+    Parameters
+    ----------
+    n_shd: Spherical harmonic decomposition order, N
+    theta: Colatitudes of the directions (array_like, radians)
+    phi: Longtitudes of the directions (array_like, radians)
+    kind: 'complex' for orthonormal complex SHs as in scipy, 'real' for their real
+        orthonormal counterparts
+
+    Returns
+    -------
+    (n_directions x (N + 1)^2) matrix of spherical harmonics in ACN channel ordering
+    '''
+    theta = np.atleast_1d(np.asarray(theta, dtype=float))[:, None]
+    phi = np.atleast_1d(np.asarray(phi, dtype=float))[:, None]
+    n, m = acn_orders(n_shd)
+
+    if kind == 'complex':
+        return _sph_harm(m, n, theta, phi)
+
+    elif kind == 'real':
+        Y = _sph_harm(np.abs(m), n, theta, phi)
+        sign = np.where(m % 2, -1., 1.)
+        return np.where(
+            m > 0, np.sqrt(2) * sign * Y.real,
+            np.where(m < 0, np.sqrt(2) * sign * Y.imag, Y.real))
+
+    else:
+        raise AssertionError(f"Choose kind from {['complex', 'real']}")
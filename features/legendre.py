@@ -2,19 +2,32 @@ from typing import Tuple
 
 import healpy as hp
 import numpy as np
-import scipy
-from tqdm import tqdm
 
 from .utils import healpix_angles, memory
 
 
+def legendre_series(N: int, x: np.ndarray) -> np.ndarray:
+    '''
+    Evaluates sum of (2n + 1)/(4 pi) P_n(x) for n = 0..N element-wise, using
+    Bonnet's recursion (n + 1) P_{n+1}(x) = (2n + 1) x P_n(x) - n P_{n-1}(x)
+    '''
+    x = np.asarray(x, dtype=float)
+    p_prev, p = np.ones_like(x), x
+    kernel = 1 / (4*np.pi) * p_prev
+    if N >= 1:
+        kernel += 3 / (4*np.pi) * p
+    for n in range(1, N):
+        p_prev, p = p, ((2*n + 1) * x * p - n * p_prev) / (n + 1)
+        kernel += (2*(n + 1) + 1) / (4*np.pi) * p
+    return kernel
+
+
 def LegendreKernel(N: int, dir1: Tuple[float, float], dir2: Tuple[float, float]) -> float:
     '''
     N-th order Legendre kernel for two angular directions
     '''
-    Pn = scipy.special.legendre
     angdist = hp.rotator.angdist(dir1, dir2).item()
-    return np.sum((2*n + 1)/(4*np.pi) * Pn(n)(np.cos(angdist)) for n in range(N + 1))  # type: ignore
+    return legendre_series(N, np.cos(angdist)).item()
 
 
 def LegendreKernelHealpix(N: int, dir: Tuple[float, float], npix: int) -> np.ndarray:
@@ -27,12 +40,16 @@ def LegendreKernelHealpix(N: int, dir: Tuple[float, float], npix: int) -> np.nda
 
 
 @memory.cache
-def generate_legendre_dict_healpix(N: int, npix: int):
+def generate_legendre_dict_healpix(N: int, npix: int) -> np.ndarray:
     '''
     Generates a dictionary from Legendre kernels on all possible HEALPix directions
+
+    Returns a contiguous (npix x npix) array, where the i-th row is the Legendre
+    kernel of the i-th HEALPix direction with respect to all grid directions
     '''
-    Lr = LegendreKernelHealpix
-    gridangles = healpix_angles(npix, lonlat=False)
+    nside = hp.npix2nside(npix)
+    vecs = np.array(hp.pix2vec(nside, np.arange(npix)))  # (3 x npix) unit vectors
 
-    return [Lr(N, dir, npix) for dir in tqdm(
-            gridangles, desc="Extracting Legendre kernels on HEALPix grid")]
+    # cosines of pairwise angular distances
+    cosines = np.clip(vecs.T @ vecs, -1., 1.)
+    return np.ascontiguousarray(legendre_series(N, cosines))
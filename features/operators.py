@@ -0,0 +1,213 @@
+'''
+Bank of precomputed operators of the RENT pipeline for a configuration of
+microphone, sampling rate, FFT size, band, SHD order and HEALPix resolution
+
+A bank is a directory of .npy files with a versioned manifest. It is loaded by
+memory-mapping, so processes share its pages instead of copying them, and
+nothing is hashed or written at extraction time.
+
+Build a bank with:
+    python -m features.operators <root> --mic em32 --fs 48000 --n_fft 1024 \
+        --fl 2608 --fh 5216 --j_nu 25 --n_shd 4 --n_pix 192
+'''
+import argparse
+import atexit
+import json
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+
+import numpy as np
+
+from .legendre import generate_legendre_dict_healpix
+from .rent import sh_operators
+from .shd import getWY, radial_equaliser
+from .utils import sph_harm_healpix
+
+VERSION = 1
+
+
+def bank_name(mic, fs, n_fft, fimin, fimax, j_nu, n_shd, n_pix):
+    '''
+    Directory name of the operator bank of a configuration
+    '''
+    return f"{mic}_fs{int(fs)}_nfft{n_fft}_f{fimin}-{fimax + j_nu}_N{n_shd}_pix{n_pix}"
+
+
+def build_operators(micstruct, fs, n_fft, fimin, fimax, j_nu, n_shd, n_pix, dictionary=True):
+    '''
+    Computes all operators of a configuration, bypassing the joblib caches
+
+    Returns a dictionary of
+    encoder: (n_bins x (N + 1)^2 x n_channels) SHD encoder of bins fimin..fimax+j_nu, see shd.getEncoder
+    srf: (n_pix x (N + 1)^2) spherical harmonics on the HEALPix grid, see srf.srf_healpix
+    dictionary: (n_pix x n_pix) Legendre kernel dictionary, see legendre.generate_legendre_dict_healpix,
+        left out unless `dictionary` is set, e.g. for fine grids whose RENT is only computed in SH domain
+    atom_norms: (n_pix) squared norms of the dictionary atoms, see rent.calculate_rent_batch
+    sh_atoms, sh_gram: SH-domain RENT operators, see rent.sh_operators
+    '''
+    freqs = np.arange(fimin, fimax + j_nu, dtype=float) * fs / n_fft
+    Bvec = radial_equaliser(micstruct, freqs, n_shd)
+    W, Y = getWY.func(micstruct, n_shd)
+    encoder = Bvec[:, :, None] * np.asarray(Y @ W)[None]
+
+    S = sph_harm_healpix.func(n_pix, n_shd)
+    sh_atoms, sh_gram, atom_norms = sh_operators(S)
+    operators = dict(encoder=encoder, srf=S, sh_atoms=sh_atoms, sh_gram=sh_gram)
+
+    if dictionary:
+        D = generate_legendre_dict_healpix.func(n_shd, n_pix)
+        operators['dictionary'] = D
+        atom_norms = np.einsum('ij, ij -> j', D, D.conj()).real
+    operators['atom_norms'] = atom_norms
+    return operators
+
+
+def save_operators(path, operators, **config):
+    '''
+    Saves operators into a bank directory, the manifest is written last so that
+    an interrupted build is not taken for a bank
+    '''
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    arrays = {}
+    for name, op in operators.items():
+        np.save(path / f"{name}.npy", np.ascontiguousarray(op))
+        arrays[name] = dict(shape=list(op.shape), dtype=op.dtype.str)
+
+    with open(path / "manifest.json", 'w') as f:
+        json.dump(dict(version=VERSION, config=config, arrays=arrays), f, indent=2)
+
+
+def load_operators(path, config=None, mmap_mode='r'):
+    '''
+    Loads operators of a bank directory as read-only memory maps
+
+    If the `config` it is expected to be of is given, e.g. dict(mic='em32', fs=48000, ...)
+    as recorded by `save_operators`, the manifest of the bank must match it, so that
+    a renamed or misplaced bank is not loaded for another configuration.
+    '''
+    path = Path(path)
+    assert (path / "manifest.json").exists(), \
+        f"No operator bank at {path}, build it with: python -m features.operators"
+
+    with open(path / "manifest.json") as f:
+        manifest = json.load(f)
+    assert manifest['version'] == VERSION, \
+        f"Operator bank at {path} is of version {manifest['version']}, rebuild it for version {VERSION}"
+    if config is not None:
+        mismatch = {k: (manifest['config'].get(k), v) for k, v in config.items()
+                    if manifest['config'].get(k) != v}
+        assert not mismatch, \
+            f"Operator bank at {path} is of another configuration, (bank, expected): {mismatch}"
+
+    return {name: np.load(path / f"{name}.npy", mmap_mode=mmap_mode)
+            for name in manifest['arrays']}
+
+
+class SharedOperators:
+    '''
+    Operators of several microphones copied once into shared memory, to be
+    attached to by worker processes with `attach_operators` instead of each one
+    loading or computing its own copy
+
+    Meant for operators computed in process. Those of operator banks are better
+    memory-mapped by each process, which shares their pages without a copy.
+
+    The shared memory is released when closed, on exit of the creating process,
+    or by the resource tracker of multiprocessing if that process crashes.
+
+    operators: Operators by microphone, e.g. {'em32': build_operators(...)}
+    '''
+
+    def __init__(self, operators):
+        self.spec = {}
+        self._shms = []
+        atexit.register(self.close)
+
+        try:
+            for mic, ops in operators.items():
+                self.spec[mic] = {}
+                for name, op in ops.items():
+                    shm = SharedMemory(create=True, size=max(op.nbytes, 1))
+                    self._shms.append(shm)
+                    np.ndarray(op.shape, op.dtype, buffer=shm.buf)[...] = op
+                    self.spec[mic][name] = (shm.name, op.shape, op.dtype.str)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for shm in self._shms:
+            shm.close()
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+        self._shms = []
+        atexit.unregister(self.close)
+
+
+# Shared memory attached to by this process, kept open for the views into it
+_attached = []
+
+
+def attach_operators(spec):
+    '''
+    Attaches to operators shared by `SharedOperators`, given its `spec`
+
+    Returns operators by microphone as read-only views into the shared memory
+    '''
+    operators = {}
+    for mic, ops in spec.items():
+        operators[mic] = {}
+        for name, (shm_name, shape, dtype) in ops.items():
+            shm = SharedMemory(name=shm_name)
+            _attached.append(shm)
+
+            op = np.ndarray(shape, dtype, buffer=shm.buf)
+            op.flags.writeable = False
+            operators[mic][name] = op
+    return operators
+
+
+def main():
+    from microphone import microphones
+
+    parser = argparse.ArgumentParser(description="Builds an operator bank for feature extraction")
+    parser.add_argument('root', type=Path, help="Directory of operator banks")
+    parser.add_argument('--mic', default='em32', choices=list(microphones))
+    parser.add_argument('--fs', type=int, default=48000)
+    parser.add_argument('--n_fft', type=int, default=1024)
+    parser.add_argument('--fl', type=float, default=2608.)
+    parser.add_argument('--fh', type=float, default=5216.)
+    parser.add_argument('--j_nu', type=int, default=25)
+    parser.add_argument('--n_shd', type=int, default=4)
+    parser.add_argument('--n_pix', type=int, default=192)
+    parser.add_argument('--no-dictionary', dest='dictionary', action='store_false',
+                        help="Leave out the (n_pix x n_pix) dictionary, for RENT in SH domain only")
+    args = parser.parse_args()
+
+    # same frequency indices as the extractor
+    config = dict(
+        mic=args.mic, fs=args.fs, n_fft=args.n_fft,
+        fimin=int(round(args.fl / args.fs * args.n_fft)),
+        fimax=int(round(args.fh / args.fs * args.n_fft)),
+        j_nu=args.j_nu, n_shd=args.n_shd, n_pix=args.n_pix)
+
+    mic = config.pop('mic')
+    operators = build_operators(microphones[mic], **config, dictionary=args.dictionary)
+
+    path = args.root / bank_name(mic, **config)
+    save_operators(path, operators, mic=mic, **config)
+    print("Operator bank saved to:", path)
+
+
+if __name__ == "__main__":
+    main()
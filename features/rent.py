@@ -1,41 +1,138 @@
 import numpy as np
 
 from .legendre import generate_legendre_dict_healpix
+from .utils import expand_band, sph_harm_healpix
 
 
-def calculate_rent_batch(dictionary, elements):
+def calculate_rent_batch(dictionary, elements, atom_norms=None, return_active=False):
     '''Compute Residual Energy Test (RENT) values
     It uses single iteration Orthogonal Matching Pursuit (OMP) algorithm.
 
+    The least-squares fit on a single active atom x has the closed-form residual
+    energy ||y||^2 - |x^T y|^2 / ||x||^2, so RENT is computed for all elements at
+    once from the atom correlations and the precomputed atom norms.
+
     dictionary: (n_features, n_components)
     elements: (..., n_features)
+    atom_norms: (n_components), squared norms of the atoms if precomputed
+    return_active: Whether to return indices of the active atoms as well
 
     Return:
     result: shape of (...)
+    active: shape of (...), if return_active
     '''
-    X = np.array(dictionary)
+    X = np.asarray(dictionary)
     Y = elements.reshape(-1, elements.shape[-1])  # features are the last dim
 
-    rcov = np.dot(X.T, Y.T)
-    active = np.argmax(np.abs(rcov), axis=0)
+    rcov = np.dot(Y, X)  # (n_elements, n_components), same as (X.T @ Y.T).T
+    active = np.argmax(np.abs(rcov), axis=1)
 
-    results = []
-    for i, y in zip(active, Y):
-        # solve for coefficients modelling active/dominant source
-        _, renergy, _, _ = np.linalg.lstsq(
-            X[:, [i]], y, rcond=None)  # fetch residual energy only
+    # energy of the projection onto the active/dominant atom
+    if atom_norms is None:
+        atom_norms = np.einsum('ij, ij -> j', X, X.conj()).real
+    ractive = np.take_along_axis(rcov, active[:, None], axis=1)[:, 0]
+    penergy = np.abs(ractive)**2 / atom_norms[active]
 
-        err = renergy / np.linalg.norm(y)**2
-        results.append(1 - err)
+    # 1 - err, where err = residual energy / ||y||^2
+    results = penergy / np.einsum('ij, ij -> i', Y, Y.conj()).real
 
     # back to a multiple domain (e.g. time-frequency) representation if given as such
-    return np.array(results).reshape(elements.shape[:-1])
+    if return_active:
+        return results.reshape(elements.shape[:-1]), active.reshape(elements.shape[:-1])
+    return results.reshape(elements.shape[:-1])
+
+
+def sh_operators(S):
+    '''Operators of RENT in the SH domain, for the Legendre kernel dictionary on a grid
+
+    By the addition theorem the dictionary is S S^H, so the correlations of the
+    SRF y = S a of SHD coefficients a with the atoms are (S S^H S) a, and its
+    energy is a^H S^H S a, neither of which needs the SRF or the dictionary.
+
+    S: (n_pix, (N + 1)^2) spherical harmonics on the grid, see srf.srf_healpix
+
+    Return:
+    atoms: (n_pix, (N + 1)^2) correlations of the atoms with the SHs
+    gram: ((N + 1)^2, (N + 1)^2) Gram matrix of the SHs on the grid
+    atom_norms: (n_pix), squared norms of the atoms
+    '''
+    gram = S.conj().T @ S
+    atoms = S @ gram
+    atom_norms = np.einsum('ij, ij -> i', atoms, S.conj()).real
+    return atoms, gram, atom_norms
+
+
+def calculate_rent_sh(atoms, gram, Anm, atom_norms, return_active=False, chunk_size=2**12):
+    '''Compute RENT values from SHD coefficients, without the SRF
+
+    Same as calculate_rent_batch on the SRF of Anm, but the atom correlations
+    cost n_pix * (N + 1)^2 rather than n_pix^2 per element, and only those of
+    `chunk_size` elements are held at once.
+
+    atoms, gram, atom_norms: see sh_operators
+    Anm: ((N + 1)^2, ...) SHD coefficients, e.g. of TF bins
+    return_active: Whether to return indices of the active atoms as well
+
+    Return:
+    result: shape of Anm.shape[1:]
+    active: shape of Anm.shape[1:], if return_active
+    '''
+    shape = Anm.shape[1:]
+    A = np.moveaxis(Anm, 0, -1).reshape(-1, Anm.shape[0])
 
+    results = np.empty(len(A))
+    active = np.empty(len(A), dtype=int)
+    for i in range(0, len(A), chunk_size):
+        a = A[i:i + chunk_size]
+        rcov = a @ atoms.T  # (n_elements, n_components), as X.T @ (S a)
+        act = np.argmax(np.abs(rcov), axis=1)
 
-def extract(srf, n_shd, fimin, fimax, j_nu):
-    n_pix = srf.shape[-1]
-    dictionary = generate_legendre_dict_healpix(n_shd, n_pix)
+        ractive = np.take_along_axis(rcov, act[:, None], axis=1)[:, 0]
+        penergy = np.abs(ractive)**2 / atom_norms[act]
+        energy = np.einsum('ij, ij -> i', a.conj(), a @ gram.T).real  # ||S a||^2
+
+        results[i:i + chunk_size] = penergy / energy
+        active[i:i + chunk_size] = act
+
+    if return_active:
+        return results.reshape(shape), active.reshape(shape)
+    return results.reshape(shape)
+
+
+def extract(srf, n_shd, fimin, fimax, j_nu, n_bins=None, dictionary=None, atom_norms=None):
+    '''
+    RENT of a band-limited SRF covering frequency indices fimin..fimax+j_nu
+
+    The result is expanded to the full frequency axis of `n_bins` bins only if
+    it is given, with zeros outside the band. A precomputed dictionary and its
+    atom norms, e.g. from an operator bank, are used if given.
+    '''
+    if dictionary is None:
+        dictionary = generate_legendre_dict_healpix(n_shd, srf.shape[-1])
+
+    rent = calculate_rent_batch(dictionary, srf, atom_norms)
+    if n_bins is not None:
+        rent = expand_band(rent, fimin, n_bins)
+    return rent
+
+
+def extract_sh(Anm, n_shd, n_pix, fimin, fimax, j_nu, n_bins=None,
+               atoms=None, gram=None, atom_norms=None):
+    '''
+    RENT of band-limited SHD coefficients covering frequency indices
+    fimin..fimax+j_nu, computed without the SRF (see calculate_rent_sh)
+
+    Same as extract on the SRF of Anm, precomputed SH-domain operators, e.g.
+    from an operator bank, are used if given.
+    '''
+    if atoms is None or gram is None:
+        atoms, gram, norms = sh_operators(sph_harm_healpix(n_pix, n_shd))
+        if atom_norms is None:
+            atom_norms = norms
+    elif atom_norms is None:
+        atom_norms = sh_operators(sph_harm_healpix(n_pix, n_shd))[2]
 
-    rent = np.zeros(srf.shape[:2], dtype=float)
-    rent[:, fimin:fimax+j_nu] = calculate_rent_batch(dictionary, srf[:, fimin:fimax+j_nu])
+    rent = calculate_rent_sh(atoms, gram, Anm, atom_norms)
+    if n_bins is not None:
+        rent = expand_band(rent, fimin, n_bins)
     return rent
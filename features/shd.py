@@ -1,71 +1,38 @@
 """
     Referenced from higrid.dpd.dpd
 """
-from collections import defaultdict
-
-import madmom as mm
 import numpy as np
 from scipy import special as spec
+from scipy.fft import irfft, next_fast_len, rfft
 
-from .utils import sph_jnyn, memory
+from .harmonics import sph_harm_matrix
+from .stft import stft
+from .utils import memory
 
 
-def preprocess_input(audio, n_fft, olap):
+def preprocess_input(audio, n_fft, olap, bins=None, frames=None, offset=0):
     """
     Preprocess the input to represent in TF domain
 
     :param audio: (n_channels x length) matrix containing the audio signal channels from em32
-    :param n_channels: Number of channels
     :param n_fft: FFT size
     :param olap: (n_fft / olap) is the hop_size of the STFT
-    :return: STFT of the microphone array recordings
+    :param bins: (start, stop) indices of the frequency bins to compute, by default all
+    :param frames: (start, stop) indices of the frames to compute, by default all
+    :param offset: Sample index of the first sample of audio, if it is a part of the signal
+    :return: STFT of the microphone array recordings (channel, time, frequency)
 
     Notes:
-    Uses STFT from madmom library since onset detection is also done by it. This can be replaced with any other TF
-    bin selection method (e.g. direct-path dominance, RENT, soundfield directivity etc.).
+    Frames the same way as the STFT of madmom library since onset detection is also done by it. This can be
+    replaced with any other TF bin selection method (e.g. direct-path dominance, RENT, soundfield directivity etc.).
     """
     assert len(
         audio.shape) == 2, f"Given audio is in unexpected shape: {audio.shape}"
-    n_channels = audio.shape[0]
-
-    def _stft(signal, ch):
-        return mm.audio.stft.STFT(signal[ch, :], frame_size=n_fft, hop_size=n_fft / olap, fft_size=n_fft)
 
-    P = np.stack([_stft(audio, ch) for ch in range(n_channels)], axis=0)
+    P = stft(audio, n_fft, hop_size=n_fft / olap, bins=bins, frames=frames, offset=offset)
     return P
 
 
-@memory.cache
-def getBmat(micstruct, findmin, findmax, NFFT, Fs, Ndec):
-    """
-    Return the array (e.g. em32) specific response equalisation matrix, B
-
-    :param micstruct: Dictionary containing microphone properties
-    :param findmin: Index of minimum frequency (int)
-    :param findmax: Index of maximum frequency (int)
-    :param NFFT: FFT size
-    :param Fs: Sampling rate (Hz)
-    :param Ndec: SHD order
-    :return: Response equalisation matrices, B, for each frequency index
-    """
-    ra = micstruct['radius']
-    Bmat = defaultdict()
-    for find in range(findmin, findmax):
-        freq = float(find) * Fs / NFFT
-        kra = 2 * np.pi * freq / 344.0 * ra
-        jn, jnp, yn, ynp = sph_jnyn(Ndec, kra)
-        # jn, jnp, yn, ynp = spec.sph_jnyn(Ndec, kra) # scipy 0.19.1
-        hn = jn - 1j * yn
-        hnp = jnp - 1j * ynp
-        bnkra = jn - (jnp / hnp) * hn
-        bval = []
-        for ind in range(Ndec + 1):
-            for _ in range(2 * ind + 1):
-                bval.append(bnkra[ind] * 4 * np.pi * (1j) ** ind)
-        Bmat[find] = np.linalg.inv(np.matrix(np.diag(bval)))
-    return Bmat
-
-
 @memory.cache
 def getWY(micstruct, Ndec):
     """
@@ -79,45 +46,147 @@ def getWY(micstruct, Ndec):
     phis = micstruct['phis']
     w = micstruct['weights']
     W = np.matrix(np.diag(w), dtype=float)
-    Y = np.matrix(np.zeros((len(thes), (Ndec + 1) ** 2), dtype=complex))
-    for ind in range(len(thes)):
-        y = []
-        for n in range(Ndec + 1):
-            for m in range(-n, n + 1):
-                Ynm = spec.sph_harm(m, n, phis[ind], thes[ind])
-                y.append(Ynm)
-        Y[ind, :] = y
+    Y = np.matrix(sph_harm_matrix(Ndec, thes, phis))  # (n_capsules x (Ndec + 1)^2)
     W = W / np.diag(Y * Y.H) / 2.
     return W, Y.H
 
 
-def getAnm(P, mstr, Bmat, findmin, findmax, Ndec):
+def radial_equaliser(micstruct, freqs, Ndec):
+    """
+    Return the diagonals of the inverse response equalisation, B^-1, at given frequencies
+
+    :param micstruct: Dictionary containing microphone properties
+    :param freqs: Frequencies (Hz)
+    :param Ndec: SHD order
+    :return: n_freqs x (Ndec + 1)^2 array, diagonals of B^-1 for each frequency
+    """
+    ra = micstruct['radius']
+    kra = 2 * np.pi * np.asarray(freqs, dtype=float) / 344.0 * ra
+
+    # Radial functions for all frequencies at once, (n_freqs x Ndec + 1)
+    n = np.arange(Ndec + 1)
+    jn = spec.spherical_jn(n, kra[:, None])
+    jnp = spec.spherical_jn(n, kra[:, None], derivative=True)
+    yn = spec.spherical_yn(n, kra[:, None])
+    ynp = spec.spherical_yn(n, kra[:, None], derivative=True)
+    hn = jn - 1j * yn
+    hnp = jnp - 1j * ynp
+    bnkra = jn - (jnp / hnp) * hn
+
+    bval = bnkra * 4 * np.pi * (1j) ** n
+    return 1. / np.repeat(bval, 2 * n + 1, axis=1)  # expand to ACN channels
+
+
+@memory.cache
+def getBvec(micstruct, findmin, findmax, NFFT, Fs, Ndec):
+    """
+    Return the array (e.g. em32) specific inverse response equalisation, B^-1, as diagonal vectors
+
+    :param micstruct: Dictionary containing microphone properties
+    :param findmin: Index of minimum frequency (int)
+    :param findmax: Index of maximum frequency (int)
+    :param NFFT: FFT size
+    :param Fs: Sampling rate (Hz)
+    :param Ndec: SHD order
+    :return: (findmax - findmin) x (Ndec + 1)^2 array, diagonals of B^-1 for each frequency index
+    """
+    freqs = np.arange(findmin, findmax, dtype=float) * Fs / NFFT
+    return radial_equaliser(micstruct, freqs, Ndec)
+
+
+def getEncoder(mstr, Bvec, Ndec):
+    """
+    Return the combined per-frequency SHD encoder, B^-1 @ Y.H @ W
+
+    :param mstr: Dict containing the microphone array properties
+    :param Bvec: Diagonals of B^-1 for each frequency index, see getBvec
+    :param Ndec: SHD order
+    :return: (n_freqs x (Ndec + 1)^2 x n_channels) encoding tensor
+    """
+    W, Y = getWY(mstr, Ndec)
+    YW = np.asarray(Y @ W)
+    return Bvec[:, :, None] * YW[None, :, :]
+
+
+def getAnm(P, mstr, Bvec, findmin, findmax, Ndec, offset=0, E=None):
     """
     Return the (N+1)^2-element list containing SHDs of STFTs
 
     :param P: STFTs of the M channels of recordings
     :param mstr: Dict containing the microphone array properties
-    :param Bmat: List of response equalisation matrices
+    :param Bvec: Diagonals of inverse response equalisation matrices, see getBvec
     :param findmin: Index of minimum frequency (int)
     :param findmax: Index of maximum frequency (int)
     :param Ndec: SHD order
-    :return: ndarray of numpy matrices containing the SHDs of STFTs of array channels (channel, time, frequency)
+    :param offset: Frequency index of the first bin of P, if it is band-limited
+    :param E: Precomputed encoder of findmin..findmax, see getEncoder, in which case mstr and Bvec are unused
+    :return: ndarray containing the SHDs of STFTs of array channels (channel, time, frequency)
     """
-    W, Y = getWY(mstr, Ndec)
+    if E is None:
+        E = getEncoder(mstr, Bvec, Ndec)
     A = np.zeros(((Ndec + 1) ** 2, *P[0].shape), dtype=complex)
-    for find in range(findmin, findmax):
-        B = Bmat[find]
-        pv = P[:, :, find]
-        anm = B @ Y @ W @ pv
-        A[:, :, find] = anm
+
+    # (freq, channel, time) batched product over all frequencies at once
+    band = slice(findmin - offset, findmax - offset)
+    pv = np.moveaxis(P[:, :, band], -1, 0)
+    A[:, :, band] = np.moveaxis(E @ pv, 0, -1)
     return A
 
 
-def extract(y, fs, n_fft, olap, n_shd, fimin, fimax, j_nu, mic):
+def encode_irs(irs, mic, fs, n_shd, band, taper, delay):
+    """
+    Return SH-domain (radial-equalised) impulse responses from capsule impulse responses
+
+    Convolving with these filters yields signals whose STFT is the SHD of the STFT of the
+    capsule signals, so the per-bin encoder can be skipped. The equaliser is only applied
+    inside the analysed band, with raised-cosine tapers to zero outside of it and at DC,
+    and the filters are delayed to be causal.
+
+    :param irs: (n_channels x n_taps) capsule impulse responses
+    :param mic: Dict containing the microphone array properties
+    :param fs: Sampling rate (Hz)
+    :param n_shd: SHD order
+    :param band: (lowest, highest) frequencies of the band to be equalised (Hz)
+    :param taper: Width of the tapers outside the band (Hz)
+    :param delay: Delay of the filters (samples)
+    :return: ((n_shd + 1)^2 x n_taps + 2 * delay) impulse responses, delayed by `delay`
+    """
+    n_taps = irs.shape[-1] + 2 * delay
+    n_fft = next_fast_len(2 * n_taps, real=True)
+    freqs = np.fft.rfftfreq(n_fft, 1. / fs)
+
+    # Raised-cosine tapered band
+    lo, hi = band
+    dist = np.maximum(lo - freqs, freqs - hi) / taper
+    gains = np.where(dist <= 0, 1., 0.5 * (1 + np.cos(np.pi * np.clip(dist, 0, 1))))
+    sel = np.flatnonzero((dist < 1) & (freqs > 0))  # B^-1 is singular at DC
+
+    H = rfft(irs, n_fft, axis=-1)
+    E = getEncoder(mic, radial_equaliser(mic, freqs[sel], n_shd), n_shd)
+
+    Hsh = np.zeros(((n_shd + 1) ** 2, len(freqs)), dtype=complex)
+    Hsh[:, sel] = np.einsum('fkm, mf -> kf', E, H[:, sel]) * gains[sel] * \
+        np.exp(-2j * np.pi * freqs[sel] * delay / fs)
+    return irfft(Hsh, n_fft, axis=-1)[:, :n_taps]
+
+
+def extract(y, fs, n_fft, olap, n_shd, fimin, fimax, j_nu, mic, encoded=False, encoder=None,
+            frames=None, offset=0):
     ''' 
     Spherical harmonic decomposition
+
+    Only the analysed band is computed, so the returned SHD is band-limited to
+    frequency indices fimin..fimax+j_nu, i.e. its frequency offset is fimin.
+    If `encoded`, y is expected to be in SH domain already, e.g. emulated with
+    impulse responses from `encode_irs`. A precomputed `encoder` of the band, e.g.
+    from an operator bank, is used instead of the microphone's if given. Only the
+    given `frames` are computed if y is a part of the signal starting at `offset`.
     '''
-    P = preprocess_input(y, n_fft, olap)  # return: STFT
-    Bmat = getBmat(mic, fimin, fimax + j_nu, n_fft, fs, n_shd)
-    Anm = getAnm(P, mic, Bmat, fimin, fimax + j_nu, n_shd)
+    P = preprocess_input(y, n_fft, olap, bins=(fimin, fimax + j_nu),
+                         frames=frames, offset=offset)  # return: STFT
+    if encoded:
+        return P.astype(complex)
+
+    Bvec = getBvec(mic, fimin, fimax + j_nu, n_fft, fs, n_shd) if encoder is None else None
+    Anm = getAnm(P, mic, Bvec, fimin, fimax + j_nu, n_shd, offset=fimin, E=encoder)
     return Anm
@@ -1,6 +1,6 @@
 import numpy as np
-from scipy.special import sph_harm
 
+from .harmonics import sph_harm_matrix
 from .utils import sph_harm_healpix
 
 
@@ -16,14 +16,11 @@ def srf(N, dir, Anm):
     Anm: Normalised SHD coefficients for each TF-bin
     '''
     theta, phi = dir  # colatitude, longtitude
-    sum = np.zeros(Anm[0].shape, dtype=complex)
-    for n in range(N + 1):
-        for m in range(-n, n+1):
-            sum += Anm[n + m + n*n] * sph_harm(m, n, phi, theta)  # inverse convention 
-    return sum
+    Y = sph_harm_matrix(N, theta, phi)[0]
+    return np.tensordot(Y, Anm[:(N + 1)**2], axes=1)  # inverse convention
 
 
-def srf_healpix(N, Anm, npix, optimize=True, lonlat=False):
+def srf_healpix(N, Anm, npix, optimize=True, lonlat=False, S=None):
     '''
     Calculate steered response functional (SRF) on all HEALPix angles
 
@@ -32,12 +29,14 @@ def srf_healpix(N, Anm, npix, optimize=True, lonlat=False):
     N: Decomposition order for spherical harmonic decomposition (SHD)
     Anm: Normalised SHD coefficients for each TF-bin
     npix: Number of pixels for HEALPix
+    S: Precomputed spherical harmonics on the HEALPix grid, see sph_harm_healpix
     '''
-    S = sph_harm_healpix(npix, N, lonlat)
+    if S is None:
+        S = sph_harm_healpix(npix, N, lonlat)
     return np.einsum('ntf, pn -> tfp', Anm, S, optimize=optimize)
 
 
-def extract(Anm, n_pix):
+def extract(Anm, n_pix, S=None):
     n_shd = int(np.sqrt(Anm.shape[0]) - 1)
-    srf = srf_healpix(n_shd, Anm, n_pix)
+    srf = srf_healpix(n_shd, Anm, n_pix, S=S)
     return srf
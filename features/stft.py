@@ -0,0 +1,65 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def frame_starts(n_samples, frame_size, hop_size):
+    '''
+    Start samples of all frames of a signal
+
+    Frames are centred on multiples of `hop_size`, the first one on the first sample,
+    and there are ceil(n_samples / hop_size) of them (as in madmom's FramedSignal).
+    '''
+    n_frames = int(np.ceil(n_samples / float(hop_size)))
+    return (np.arange(n_frames) * hop_size).astype(int) - frame_size // 2
+
+
+def stft(audio, n_fft, hop_size, bins=None, window=np.hanning, block_size=2**23, frames=None, offset=0):
+    '''
+    Short-time Fourier transform of all channels of a multichannel signal at once
+
+    Frames of all channels are taken as strided views of the zero-padded signal and
+    transformed with a single batched real FFT per block of frames.
+
+    Parameters
+    ----------
+    audio: (n_channels x n_samples) signal
+    n_fft: Frame and FFT size
+    hop_size: Hop size in samples, may be fractional
+    bins: (start, stop) indices of the frequency bins to return, by default all
+        bins below the Nyquist frequency, i.e. (0, n_fft // 2)
+    window: Window function, called with the frame size
+    block_size: Approximate number of samples framed at once, bounds the memory
+        used for the framed signal
+    frames: (start, stop) indices of the frames to return, by default all frames
+        of the signal, i.e. (0, ceil(n_samples / hop_size))
+    offset: Sample index of the first sample of `audio` within the signal, when
+        only a part of it is given, samples outside `audio` are taken as zeros
+
+    Returns
+    -------
+    (n_channels x n_frames x n_bins) complex64 STFT
+    '''
+    audio = np.atleast_2d(audio)
+    n_channels, n_samples = audio.shape
+    fstart, fstop = bins or (0, n_fft // 2)
+
+    if frames is None:
+        starts = frame_starts(n_samples, n_fft, hop_size)
+    else:
+        starts = (np.arange(*frames) * hop_size).astype(int) - n_fft // 2 - offset
+    n_frames = len(starts)
+
+    # zero padding so that every frame lies inside the signal
+    pad_left = max(0, -starts[0]) if n_frames else 0
+    pad_right = max(0, starts[-1] + n_fft - n_samples) if n_frames else 0
+    padded = np.pad(audio, ((0, 0), (pad_left, pad_right)))
+    framed = sliding_window_view(padded, n_fft, axis=-1)  # no copy
+
+    win = window(n_fft)
+    P = np.empty((n_channels, n_frames, fstop - fstart), dtype=np.complex64)
+
+    step = max(1, block_size // (n_channels * n_fft))
+    for i in range(0, n_frames, step):
+        block = framed[:, starts[i:i + step] + pad_left]
+        P[:, i:i + step] = np.fft.rfft(block * win, n=n_fft, axis=-1)[..., fstart:fstop]
+    return P
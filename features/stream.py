@@ -0,0 +1,213 @@
+'''
+Streaming RENT and DOA estimation for live spherical microphone array input
+
+Blocks of multichannel samples are pushed into a ring buffer, and every STFT
+frame is processed as soon as its last sample arrives, i.e. with a latency of
+half a frame plus the processing time. Frames are the same as those of the
+offline pipeline (see stft.stft), and RENT is computed in SH domain without
+the SRF (see rent.calculate_rent_sh), so a replayed recording yields the same
+RENT as `rent_pipe` on the whole recording, to within rounding.
+
+Replay a recording faster than real time and report latencies with:
+    python -m features.stream <wav> --block 256
+'''
+import argparse
+from time import perf_counter, sleep
+
+import numpy as np
+
+from . import rent, shd
+from .operators import build_operators
+from .utils import healpix_grid
+
+
+class StreamingRent:
+    '''
+    Streaming RENT, SRF peaks and DOA estimator
+
+    mic: Dict containing the microphone array properties
+    fs: Sampling rate (Hz)
+    n_fft: FFT size
+    olap: (n_fft / olap) is the hop size of the STFT
+    n_shd: SHD order
+    fimin, fimax, j_nu: Analysed band, frequency indices fimin..fimax+j_nu
+    n_pix: Number of pixels for HEALPix
+    operators: Precomputed operators of the configuration, see features.operators
+    '''
+
+    def __init__(self, mic, fs, n_fft, olap, n_shd, fimin, fimax, j_nu, n_pix, operators=None):
+        self.n_fft = n_fft
+        self.hop_size = n_fft / olap
+        self.n_shd = n_shd
+        self.band = (fimin, fimax + j_nu)
+        self.n_pix = n_pix
+
+        ops = operators or build_operators(mic, fs, n_fft, fimin, fimax, j_nu, n_shd, n_pix,
+                                           dictionary=False)
+        if 'sh_atoms' not in ops:
+            # bank built before SH-domain RENT
+            atoms, gram, _ = rent.sh_operators(ops['srf'])
+            ops = dict(ops, sh_atoms=atoms, sh_gram=gram)
+        self._encoder = ops['encoder']
+        self._atoms = ops['sh_atoms']
+        self._gram = ops['sh_gram']
+        self._atom_norms = ops['atom_norms']
+        self._window = np.hanning(n_fft)
+        self._directions = np.stack(healpix_grid(n_pix), axis=-1)  # (colatitude, longtitude)
+
+        self.n_channels = self._encoder.shape[-1]
+        self._capacity = 2 ** int(np.ceil(np.log2(4 * n_fft)))
+        self.reset()
+
+    def reset(self):
+        '''
+        Starts a new stream
+        '''
+        # Samples are counted from the start of the zero padding of the first frame
+        self._ring = np.zeros((self.n_channels, self._capacity))
+        self._written = self.n_fft // 2
+        self._n_frames = 0
+
+    def push(self, block):
+        '''
+        Processes a block of samples, returning the results of all frames completed by it
+
+        block: (n_channels x n_samples) samples, of any length
+        Returns a dictionary of
+            frame: (n_frames) indices of the frames
+            rent: (n_frames x n_bins) RENT of the band
+            peak: (n_frames x n_bins) HEALPix pixel of the SRF peak, i.e. the active atom, of each bin
+            doa: (n_frames x 2) direction (colatitude, longtitude) of the pixel most voted by the bins, weighted by RENT
+        '''
+        block = np.atleast_2d(block)
+        assert block.shape[0] == self.n_channels, \
+            f"Expected {self.n_channels} channels, got {block.shape[0]}"
+
+        results = []
+        step = self._capacity - self.n_fft  # samples that fit without overwriting unprocessed frames
+        for i in range(0, block.shape[1], step):
+            self._write(block[:, i:i + step])
+            results.append(self._process())
+        return self._concatenate(results)
+
+    def flush(self):
+        '''
+        Processes the remaining frames, zero-padded as in the offline STFT, and
+        starts a new stream
+        '''
+        n_samples = self._written - self.n_fft // 2
+        n_frames = int(np.ceil(n_samples / self.hop_size))
+
+        results = []
+        while self._n_frames < n_frames:
+            self._write(np.zeros((self.n_channels, self._capacity - self.n_fft)))
+            results.append(self._process(n_frames))
+
+        self.reset()
+        return self._concatenate(results)
+
+    def _write(self, block):
+        idx = (self._written + np.arange(block.shape[1])) % self._capacity
+        self._ring[:, idx] = block
+        self._written += block.shape[1]
+
+    def _process(self, max_frames=None):
+        # Frames whose last sample is written, frame i starts at int(i * hop_size)
+        n_ready = int(np.floor((self._written - self.n_fft) / self.hop_size)) + 1
+        if max_frames is not None:
+            n_ready = min(n_ready, max_frames)
+
+        frames = np.arange(self._n_frames, max(n_ready, self._n_frames))
+        self._n_frames += len(frames)
+        if not len(frames):
+            return None
+
+        starts = (frames * self.hop_size).astype(int)
+        idx = (starts[:, None] + np.arange(self.n_fft)) % self._capacity
+        fstart, fstop = self.band
+        P = np.fft.rfft(self._ring[:, idx] * self._window, axis=-1)[..., fstart:fstop]
+        P = P.astype(np.complex64)  # as the offline STFT
+
+        Anm = shd.getAnm(P, None, None, fstart, fstop, self.n_shd, offset=fstart, E=self._encoder)
+        R, peak = rent.calculate_rent_sh(
+            self._atoms, self._gram, Anm, self._atom_norms, return_active=True)
+
+        # DOA by RENT-weighted votes of the bins for their peaks
+        votes = np.zeros((len(frames), self.n_pix))
+        np.add.at(votes, (np.arange(len(frames))[:, None], peak), R)
+        doa = self._directions[votes.argmax(axis=1)]
+
+        return dict(frame=frames, rent=R, peak=peak, doa=doa)
+
+    def _concatenate(self, results):
+        results = [r for r in results if r is not None]
+        if not results:
+            n_bins = self.band[1] - self.band[0]
+            return dict(frame=np.zeros(0, int), rent=np.zeros((0, n_bins)),
+                        peak=np.zeros((0, n_bins), int), doa=np.zeros((0, 2)))
+        return {k: np.concatenate([r[k] for r in results]) for k in results[0]}
+
+
+def replay(engine, audio, block_size, fs=None, speed=None):
+    '''
+    Replays a recording through a streaming engine block by block
+
+    audio: (n_channels x n_samples) recording
+    block_size: Number of samples per block
+    fs: Sampling rate (Hz), only needed to pace the replay
+    speed: Replay speed relative to real time, as fast as possible if not given
+    Returns the results of all frames and the latency of each block (s)
+    '''
+    results, latencies = [], []
+    tic = perf_counter()
+    for i in range(0, audio.shape[1], block_size):
+        if speed:
+            # wait for the block to be "recorded"
+            sleep(max(0., tic + (i + block_size) / fs / speed - perf_counter()))
+
+        start = perf_counter()
+        results.append(engine.push(audio[:, i:i + block_size]))
+        latencies.append(perf_counter() - start)
+
+    results.append(engine.flush())
+    return engine._concatenate(results), np.array(latencies)
+
+
+def main():
+    from microphone import microphones
+    from utils import wavread
+
+    parser = argparse.ArgumentParser(description="Replays a multichannel recording through the streaming RENT engine")
+    parser.add_argument('wav', help="Multichannel recording of the microphone array")
+    parser.add_argument('--mic', default='em32', choices=list(microphones))
+    parser.add_argument('--block', type=int, default=256, help="Samples per block")
+    parser.add_argument('--speed', type=float, default=None, help="Replay speed relative to real time, as fast as possible by default")
+    parser.add_argument('--n_fft', type=int, default=1024)
+    parser.add_argument('--olap', type=int, default=4)
+    parser.add_argument('--fl', type=float, default=2608.)
+    parser.add_argument('--fh', type=float, default=5216.)
+    parser.add_argument('--j_nu', type=int, default=25)
+    parser.add_argument('--n_shd', type=int, default=4)
+    parser.add_argument('--n_pix', type=int, default=192)
+    args = parser.parse_args()
+
+    sig, fs = wavread(args.wav)
+    audio = sig.T
+
+    engine = StreamingRent(
+        microphones[args.mic], fs, args.n_fft, args.olap, args.n_shd,
+        fimin=int(round(args.fl / fs * args.n_fft)),
+        fimax=int(round(args.fh / fs * args.n_fft)),
+        j_nu=args.j_nu, n_pix=args.n_pix)
+
+    results, latencies = replay(engine, audio, args.block, fs, args.speed)
+
+    duration = audio.shape[1] / fs
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1e3
+    print(f"Frames: {len(results['frame'])}, blocks: {len(latencies)} of {args.block / fs * 1e3:.2f} ms")
+    print(f"Block latency (ms): p50 {p50:.3f}, p90 {p90:.3f}, p99 {p99:.3f}, max {latencies.max() * 1e3:.3f}")
+    print(f"Real-time factor: {latencies.sum() / duration:.3f}")
+
+
+if __name__ == "__main__":
+    main()
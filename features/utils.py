@@ -1,36 +1,63 @@
+import functools
+import os
 from pathlib import Path
 
 import healpy as hp
 import numpy as np
 from joblib import Memory
-from scipy import signal as sp
-from scipy import special as sp
+
+from .harmonics import sph_harm_matrix
 
 cache_dir = Path(__file__).parents[1] / ".cache"
-memory = Memory(cache_dir, verbose=0)
 
+# Cache location of processes started by this one, '' if caching is disabled
+CACHE_DIR_ENV = 'RENT_CACHE_DIR'
+
+
+class CacheMemory:
+    '''
+    joblib Memory whose location can be changed after functions are decorated,
+    e.g. when the package directory is read-only, see set_cache_dir
 
-def sph_jnyn(N, kr):
+    location: Cache directory, nothing is cached or written if None
     '''
-    Returns spherical Bessel functions of the first (jn) and second kind (yn) and their derivatives
 
-    :param N: Function order
-    :param kr: Argument
-    :return: jn, jn', yn, yn'
+    def __init__(self, location):
+        self.location = location
 
-    NOTE: Emulates the behaviour of sph_jnyn() in early versions of scipy (< 1.0.0).
+    def cache(self, func):
+        return CachedFunction(self, func)
 
+
+class CachedFunction:
+    '''
+    Function cached in the current location of a CacheMemory, the uncached
+    function is `func` as for joblib
     '''
-    jn = np.zeros(N+1)
-    jnp = np.zeros(N+1)
-    yn = np.zeros(N+1)
-    ynp = np.zeros(N+1)
-    for n in range(N+1):
-        jn[n] = sp.spherical_jn(n, kr)
-        jnp[n] = sp.spherical_jn(n, kr, derivative=True)
-        yn[n] = sp.spherical_yn(n, kr)
-        ynp[n] = sp.spherical_yn(n, kr, derivative=True)
-    return jn, jnp, yn, ynp
+
+    def __init__(self, memory, func):
+        functools.update_wrapper(self, func)
+        self.memory = memory
+        self.func = func
+        self._memorized = {}  # by location
+
+    def __call__(self, *args, **kwargs):
+        location = self.memory.location
+        if location not in self._memorized:
+            self._memorized[location] = Memory(location, verbose=0).cache(self.func)
+        return self._memorized[location](*args, **kwargs)
+
+
+def set_cache_dir(location):
+    '''
+    Moves the cache of this process and of processes started by it to a
+    directory, or disables caching if None
+    '''
+    memory.location = None if location is None else str(location)
+    os.environ[CACHE_DIR_ENV] = memory.location or ''
+
+
+memory = CacheMemory(os.environ.get(CACHE_DIR_ENV, str(cache_dir)) or None)
 
 
 def rel_energy(y, value, valuetype='db') -> float:
@@ -53,19 +80,37 @@ def rel_energy(y, value, valuetype='db') -> float:
         raise AssertionError(f"Choose type from {types_available}")
 
 
-def healpix_angles(npix: int, lonlat=False):
+def expand_band(x, offset, n_bins, axis=-1):
+    """
+    Expands a band-limited array to the full frequency axis, zero outside the band
+
+    :param x: Band-limited array
+    :param offset: Frequency index of the first bin of the band
+    :param n_bins: Number of bins of the full frequency axis
+    :param axis: Frequency axis of x
+    :return: Array with `n_bins` bins along the frequency axis
+    """
+    x = np.moveaxis(x, axis, -1)
+    out = np.zeros((*x.shape[:-1], n_bins), dtype=x.dtype)
+    out[..., offset:offset + x.shape[-1]] = x
+    return np.moveaxis(out, -1, axis)
+
+
+def healpix_grid(npix: int, lonlat=False):
+    """
+    Returns angles of all HEALPix pixel centres as two arrays, (theta, phi), or
+    (lon, lat) in degrees if `lonlat` is enabled
+    """
     nside = hp.npix2nside(npix)
-    gridangles = [hp.pix2ang(nside, i, lonlat=lonlat) for i in range(npix)]
+    return hp.pix2ang(nside, np.arange(npix), lonlat=lonlat)
+
+
+def healpix_angles(npix: int, lonlat=False):
+    gridangles = list(zip(*healpix_grid(npix, lonlat)))
     return gridangles
 
 
 @memory.cache
 def sph_harm_healpix(n_pix, n_shd, lonlat=False):
-    S = np.zeros((n_pix, (n_shd + 1)**2), dtype=complex)
-    gridangles = healpix_angles(n_pix, lonlat)
-
-    for i, (theta, phi) in enumerate(gridangles):
-        for n in range(n_shd + 1):
-            for m in range(-n, n+1):
-                S[i, (n + m + n*n)] = sp.sph_harm(m, n, phi, theta)
-    return S
+    theta, phi = healpix_grid(n_pix, lonlat)
+    return sph_harm_matrix(n_shd, theta, phi)
@@ -1,72 +1,105 @@
-from multiprocessing import Process
 from pathlib import Path
 
 import hydra
-from omegaconf import DictConfig
+from hydra.utils import to_absolute_path
+from omegaconf import DictConfig, OmegaConf
 
 from dataset import smir_datasets
 from extractor import Extractor
-from utils.extract import (create_input_generator, create_progress_bar,
-                           print_config)
-
-
-def run_serial(extractor, input_gen, save, n_audio, n_scenario):
-    from time import sleep
-    n_total: int = n_audio * n_scenario
-
-    with create_progress_bar() as pgs:
-        pgs.console.print(f"# of scenarios: {n_scenario}")
-        pgs.console.print(f"# of anechoic sounds: {n_audio}")
-        task = pgs.add_task("[green]Feature extraction...", total=n_total)
-
-        for fpath, scenario in input_gen:
-            pgs.console.print(f"\n>>> {fpath.stem}")
-            pgs.console.print(f"{scenario}")
-            extractor.job(fpath, scenario, save=save)
-            pgs.advance(task)
-            sleep(1.0)
-
-
-def progress_bar_background(n_audio: int, n_scenario: int):
-    from time import sleep
-    n_total: int = n_audio * n_scenario
-
-    with create_progress_bar() as pgs:
-        print()
-        pgs.console.print(f"# of scenarios: {n_scenario}")
-        pgs.console.print(f"# of anechoic sounds: {n_audio}")
-        task = pgs.add_task("[green]Feature extraction...", total=n_total)
-
-        while True:
-            output_cnt = len(list(Path.cwd().glob("**/*.npy")))
-            pgs.update(task, completed=output_cnt)
-            sleep(1.0)
-
-
-def run_parallel(extractor, input_gen, save, n_threads):
-    from functools import partial
-    from multiprocessing import Pool
-
-    job = partial(extractor.job, save=save)
-
-    with Pool(processes=n_threads) as pool:
-        pool.starmap(job, input_gen)
-
-
-def prepare(config):
+from features.operators import SharedOperators
+from utils.extract import (ExtractionProgress, configure_cache,
+                           create_input_generator, create_ir_cache, init_worker,
+                           print_config, run_task, split_inputs)
+from utils.ledger import JobLedger, params_hash
+from utils.store import FeatureStore
+
+
+def run_serial(extractor, input_gen, save, progress, ledger=None):
+    from dataset.utils import Source
+
+    for fpath, scenarios in input_gen:
+        progress.console.print(f"\n>>> {fpath.stem}")
+        source = Source.from_file(fpath)
+        duration = len(source) / extractor.params['fs']
+
+        for scenario, _ in zip(scenarios, extractor.iter_jobs(fpath, scenarios, save=save, source=source)):
+            progress.console.print(f"{scenario}")
+            progress.update(dict(ok=True, duration=duration))
+            if ledger is not None:
+                ledger.record(fpath, scenario)
+
+
+def run_parallel(config, input_gen, save, n_threads, progress, ledger=None, store=None, shared=None,
+                 dataset_index=None, n_files=1):
+    from multiprocessing import Pool, Queue, TimeoutError
+    from queue import Empty
+
+    # Operators are shared by the parent once, workers attach to them
+    shared = shared or SharedOperators({})
+
+    # Workers report each job as soon as it is done, not once per task
+    events = Queue()
+
+    # Workers build their own extractor once, tasks only carry their inputs
+    initargs = (config.params, config.dataset._name_, config.paths.smir,
+                config.ir_cache_mb, config.blas_threads, store, config.operator_banks,
+                shared.spec, config.ir_trim, events, dataset_index)
+    # At least a chunk of scenarios per worker, even with fewer anechoic files
+    tasks = ((fpath, scenarios, save) for fpath, scenarios in
+             split_inputs(input_gen, n_threads, n_files, config.min_chunk))
+
+    statuses = []
+    with shared, Pool(processes=n_threads, initializer=init_worker, initargs=initargs) as pool:
+        results = pool.imap_unordered(run_task, tasks, chunksize=config.chunksize)
+        n_jobs, finished = 0, False  # jobs of the tasks done so far
+        while not finished or len(statuses) < n_jobs:
+            while not finished:
+                try:
+                    n_jobs += len(results.next(timeout=0))
+                except TimeoutError:
+                    break
+                except StopIteration:
+                    finished = True
+
+            try:
+                status = events.get(timeout=.1)
+            except Empty:
+                continue
+
+            if not status['ok']:
+                progress.console.print(
+                    f"[red]Failed: {status['audio']} {status['scenario']}\n{status['error']}")
+            elif ledger is not None:
+                ledger.record(status['audio'], status['scenario'], elapsed=status['elapsed'])
+            progress.update(status)
+            statuses.append(status)
+
+    return statuses
+
+
+def result_configs(config):
+    ''' Configurations the extracted features depend on '''
+    configs = [config.params, config.dataset]
+    if config.ir_trim.db is not None:
+        configs.append(OmegaConf.masked_copy(config.ir_trim, ['db', 'kind']))
+    return configs
+
+
+def prepare(config, ledger=None, on_skip=None, store=None):
     ''' Dataset '''
     Dataset = smir_datasets[config.dataset._name_]
     dataset = Dataset(config.paths.smir)
 
     ''' Extractor '''
-    extractor = Extractor(config.params, dataset)
+    ir_cache = create_ir_cache(config.ir_cache_mb, config.ir_trim)
+    extractor = Extractor(config.params, dataset, ir_cache, store, config.operator_banks)
 
     ''' Input generator '''
     audio_folder = config.paths.anechoic
     audio_files = list(Path(audio_folder).glob("**/*.wav"))
 
     input_gen = create_input_generator(
-        audio_files, dataset, resume=config.resume)
+        audio_files, dataset, ledger=ledger if config.resume else None, on_skip=on_skip)
 
     return dataset, extractor, audio_files, input_gen
 
@@ -75,24 +108,50 @@ def prepare(config):
 def main(config: DictConfig):
     print_config(config)
     
+    # Relative to the original working directory, for workers as well
+    if config.operator_banks is not None:
+        config.operator_banks = to_absolute_path(config.operator_banks)
+    configure_cache(config.cache_dir, config.operator_banks, config.index_cache_dir)
+
     # Prepare for extraction
-    dataset, extractor, audio_files, input_gen = prepare(config)
+    progress = ExtractionProgress()
+    ledger = JobLedger(config.ledger, params_hash(*result_configs(config)))
+    store = FeatureStore(Path.cwd() / config.store.path, config.store.dtype, ledger.params_id) \
+        if config.save and config.store.path else None
+    dataset, extractor, audio_files, input_gen = prepare(
+        config, ledger=ledger, on_skip=progress.skip, store=store)
 
     if config.save:
         from rich import print as pprint
         pprint("Saving to:", Path.cwd())
 
+    # Only saved results are recorded as completed
+    record = ledger if config.save else None
+
     # Choose running serial or parallel
-    if config.n_threads <= 1:
-        run_serial(extractor, input_gen, save=config.save, n_audio=len(
-            audio_files), n_scenario=len(dataset.metadata))
-    else:
-        pbar = Process(target=progress_bar_background, args=(
-            len(audio_files), len(dataset.metadata)))
-        pbar.start()
-        run_parallel(extractor, input_gen, save=config.save,
-                     n_threads=config.n_threads)
-        pbar.join()
+    with ledger, progress.start(n_audio=len(audio_files), n_scenario=len(dataset.metadata)):
+        if config.n_threads <= 1:
+            run_serial(extractor, input_gen, save=config.save,
+                       progress=progress, ledger=record)
+        else:
+            # Only operators computed here are copied into shared memory, and only
+            # the copies are kept. Bank-backed ones are memory-mapped by each worker
+            # instead, as their pages are shared by the page cache already
+            mics = dataset.metadata['mic'].unique()
+            if config.operator_banks is None:
+                shared = SharedOperators({mic: extractor.load_operators(mic, build=True) for mic in mics})
+            else:
+                for mic in mics:
+                    extractor.load_operators(mic)  # checks that the banks exist
+                shared = SharedOperators({})
+            extractor.operators.clear()
+
+            run_parallel(config, input_gen, save=config.save, n_threads=config.n_threads,
+                         progress=progress, ledger=record, store=store, shared=shared,
+                         dataset_index=dataset.index, n_files=len(audio_files))
+
+    if store is not None:
+        store.close()
 
 
 if __name__ == "__main__":
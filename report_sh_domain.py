@@ -0,0 +1,36 @@
+from pathlib import Path
+
+import hydra
+from omegaconf import DictConfig
+
+from dataset import smir_datasets
+from utils.extract import configure_cache, print_config, sh_domain_report
+
+
+@hydra.main(config_path='configs', config_name='config', version_base=None)
+def main(config: DictConfig):
+    print_config(config)
+    configure_cache(config.cache_dir, index_cache_dir=config.index_cache_dir)
+
+    Dataset = smir_datasets[config.dataset._name_]
+    dataset = Dataset(config.paths.smir)
+
+    audio_files = sorted(Path(config.paths.anechoic).glob("**/*.wav"))
+    audio_files = audio_files[:config.sh_domain_report.audio]
+
+    tol = config.sh_domain_report
+    report = sh_domain_report(
+        config.params, dataset, audio_files, anm_p99=tol.anm_p99, rent_p99=tol.rent_p99)
+    report.to_csv(Path.cwd() / "sh_domain_report.csv", index=False)
+
+    summary = report[['anm_p50', 'anm_p99', 'rent_p50', 'rent_p99', 'rent_max']].agg(['mean', 'max'])
+    print(summary.to_string())
+    print("Report saved to:", Path.cwd() / "sh_domain_report.csv")
+
+    failed = report[~report['passed']]
+    assert failed.empty, \
+        f"{len(failed)} of {len(report)} jobs exceed the tolerances (anm_p99 {tol.anm_p99}, rent_p99 {tol.rent_p99})"
+
+
+if __name__ == "__main__":
+    main()
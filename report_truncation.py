@@ -0,0 +1,33 @@
+from pathlib import Path
+
+import hydra
+from omegaconf import DictConfig
+
+from dataset import smir_datasets
+from utils.extract import configure_cache, print_config, truncation_report
+
+
+@hydra.main(config_path='configs', config_name='config', version_base=None)
+def main(config: DictConfig):
+    print_config(config)
+    configure_cache(config.cache_dir, index_cache_dir=config.index_cache_dir)
+
+    Dataset = smir_datasets[config.dataset._name_]
+    dataset = Dataset(config.paths.smir)
+
+    audio_files = sorted(Path(config.paths.anechoic).glob("**/*.wav"))
+    audio_files = audio_files[:config.ir_trim.report_audio]
+
+    report = truncation_report(
+        config.params, dataset, audio_files,
+        thresholds_db=config.ir_trim.report_db, kind=config.ir_trim.kind)
+    report.to_csv(Path.cwd() / "truncation_report.csv", index=False)
+
+    summary = report.groupby('threshold_db')[
+        ['taps', 'residual_db', 'max_diff', 'mean_diff', 'rel_diff']].agg(['mean', 'max'])
+    print(summary.to_string())
+    print("Report saved to:", Path.cwd() / "truncation_report.csv")
+
+
+if __name__ == "__main__":
+    main()
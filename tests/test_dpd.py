@@ -0,0 +1,24 @@
+import numpy as np
+
+from features import dpd, shd
+from microphone import microphones
+
+
+def test_extract_ratios_of_band_limited_shd():
+    fs, n_fft, olap, n_shd = 48000, 1024, 4, 2
+    fimin, fimax, j_nu, j_tau = 56, 72, 5, 4
+    rng = np.random.default_rng(0)
+    y = rng.standard_normal((32, 16 * n_fft))
+    mic = microphones['em32']
+
+    Anm = shd.extract(y, fs, n_fft, olap, n_shd, fimin, fimax, j_nu, mic)
+    ratios = dpd.extract_ratios(Anm, n_shd, fimin, fimax, j_tau, j_nu, fi_offset=fimin)
+
+    # Reference from the same SHD zero-padded to the full frequency axis
+    full = np.zeros(Anm.shape[:2] + (fimax + j_nu,), dtype=Anm.dtype)
+    full[..., fimin:] = Anm
+    expected = [dpd.singular_ratio(full, n_shd, f, t, j_tau, j_nu)
+                for t in range(Anm.shape[1] - j_tau) for f in range(fimin, fimax)]
+
+    assert ratios.shape == ((Anm.shape[1] - j_tau) * (fimax - fimin),)
+    np.testing.assert_allclose(ratios, expected, rtol=1e-10)
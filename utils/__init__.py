@@ -1 +1,2 @@
-from .acoustics import wavread
\ No newline at end of file
+from .acoustics import wavread
+from .wav import read_channels, read_wav, wav_info
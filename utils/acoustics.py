@@ -1,13 +1,9 @@
 import numpy as np
 
-# Ignore warnings related to metadata blocks
-import warnings
-from scipy.io import wavfile
+from .wav import read_wav
 
-warnings.filterwarnings("ignore", category=wavfile.WavFileWarning)
 
-
-def wavread(path):
+def wavread(path, start=0, stop=None, dtype=np.float64, mmap=True):
     """
     Read WAVE files into an ndarray
 
@@ -15,26 +11,21 @@ def wavread(path):
     ----------
     path: str, PathLike or open file handle
         Path to the impulse response wav file.
+    start, stop: int, optional
+        Range of samples to read, by default all.
+    dtype: dtype, optional
+        Data type of the output, by default float64.
+    mmap: bool, optional
+        Whether to read through a memory map, by default True.
 
     Returns
     -------
     sig: ndarray
-        Data read from WAVE file.
+        Data read from WAVE file, integer samples scaled by 1 / (2^(nb_bits - 1) + 1).
     fs: int
         Sample rate of the WAVE file.
     """
-    from scipy.io import wavfile
-
-    fs, sig = wavfile.read(path)
-
-    if sig.dtype == 'int16':
-        nb_bits = 16  # -> 16-bit wav files
-    elif sig.dtype == 'int32':
-        nb_bits = 32  # -> 32-bit wav files
-    max_nb_bit = float(2 ** (nb_bits - 1))
-
-    sig = sig / (max_nb_bit + 1)
-    return sig, fs
+    return read_wav(path, start, stop, dtype=dtype, mmap=mmap)
 
 
 def measure_rt60(h, fs=1, decay_db=60):
@@ -84,6 +75,76 @@ def measure_rt60(h, fs=1, decay_db=60):
     return est_rt60
 
 
+def schroeder_decay(h, axis=-1):
+    """
+    Energy decay curves of impulse responses by Schroeder integration, for all
+    channels at once.
+
+    Parameters
+    ----------
+    h: array_like
+        Impulse responses, e.g. (n_channels x n_taps).
+    axis: int, optional
+        Time axis of h, by default the last one.
+
+    Returns
+    -------
+    edc: ndarray
+        Remaining energy at each sample, in dB relative to the total energy of each
+        channel, -inf once all energy is integrated.
+    """
+    power = np.moveaxis(np.asarray(h, dtype=float), axis, -1) ** 2
+    energy = np.cumsum(power[..., ::-1], axis=-1)[..., ::-1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        edc = 10 * np.log10(energy / energy[..., :1])
+    return np.moveaxis(np.nan_to_num(edc, nan=-np.inf), -1, axis)
+
+
+def truncation_point(h, threshold_db, kind='energy'):
+    """
+    Length to which multichannel impulse responses can be truncated, common to
+    all channels so that they stay aligned.
+
+    Parameters
+    ----------
+    h: array_like
+        (n_channels x n_taps) impulse responses.
+    threshold_db: float
+        Truncation threshold in dB, positive.
+    kind: str, optional
+        'energy' to truncate where the remaining energy of every channel is below
+        the threshold (see `schroeder_decay`), 'direct' to truncate after the last
+        sample of any channel whose power is within the threshold of its peak,
+        i.e. of its direct path. By default 'energy'.
+
+    Returns
+    -------
+    n_taps: int
+        Number of samples to keep.
+    residual_db: float
+        Largest energy discarded from a channel, in dB relative to its total energy.
+    """
+    h = np.atleast_2d(h)
+    edc = schroeder_decay(h)
+
+    if kind == 'energy':
+        below = edc < -threshold_db
+    elif kind == 'direct':
+        power = h ** 2
+        above = power >= power.max(axis=-1, keepdims=True) * 10 ** (-threshold_db / 10)
+        below = np.cumsum(above[:, ::-1], axis=-1)[:, ::-1] == 0  # after the last sample above
+    else:
+        raise AssertionError(f"Choose kind from {['energy', 'direct']}")
+
+    # First sample below the threshold of each channel, or the whole length
+    first = np.where(below.any(axis=-1), below.argmax(axis=-1), h.shape[-1])
+    n_taps = max(int(first.max()), 1)
+
+    residual_db = edc[:, n_taps].max() if n_taps < h.shape[-1] else -np.inf
+    return n_taps, float(residual_db)
+
+
 def measure_drr(path, correction=1.45e-3):
     """
     Analyse direct-to-reverberant ratio (DRR) of an impulse response.
@@ -1,14 +1,19 @@
-from itertools import product
-from pathlib import Path
+import os
+from contextlib import contextmanager
+from datetime import timedelta
+from threading import Lock
+from time import perf_counter
 
 import rich.syntax
 import rich.tree
-from omegaconf import DictConfig, OmegaConf
+from omegaconf import DictConfig, OmegaConf, open_dict
 
 from dataset import SMIRDataset
+from utils.ledger import JobLedger
+from utils.store import FeatureStore
 
 
-def create_progress_bar():
+def create_progress_bar(*columns):
     from rich.progress import (BarColumn, MofNCompleteColumn, Progress,
                                SpinnerColumn, TaskProgressColumn, TextColumn,
                                TimeElapsedColumn, TimeRemainingColumn)
@@ -19,11 +24,69 @@ def create_progress_bar():
         SpinnerColumn(),
         TimeElapsedColumn(),
         BarColumn(),
-        TimeRemainingColumn(),
+        *(columns or [TimeRemainingColumn()]),
         MofNCompleteColumn()
     )
 
 
+class ExtractionProgress:
+    """
+    Progress, throughput and ETA of feature extraction, driven by job completion
+    events (see `run_task` statuses) rather than by polling the outputs.
+
+    Jobs skipped by resuming are counted as completed, but not for throughput and ETA.
+    """
+
+    def __init__(self):
+        from rich.progress import TextColumn
+
+        self._pgs = create_progress_bar(TextColumn("{task.fields[stats]}"))
+        self._lock = Lock()
+        self.n_total = self.n_skipped = self.n_done = self.n_failed = 0
+        self.audio_seconds = 0.
+
+    @property
+    def console(self):
+        return self._pgs.console
+
+    @contextmanager
+    def start(self, n_audio: int, n_scenario: int):
+        self.n_total = n_audio * n_scenario
+
+        with self._pgs:
+            self.console.print(f"# of scenarios: {n_scenario}")
+            self.console.print(f"# of anechoic sounds: {n_audio}")
+            self._task = self._pgs.add_task(
+                "[green]Feature extraction...", total=self.n_total, stats="")
+            self._tic = perf_counter()
+
+            yield self
+
+            self.console.print(self._stats() + f", {self.n_skipped} resumed")
+
+    def skip(self, n: int):
+        with self._lock:
+            self.n_skipped += n
+        self._pgs.advance(self._task, n)
+
+    def update(self, status):
+        with self._lock:
+            self.n_done += 1
+            self.n_failed += not status['ok']
+            self.audio_seconds += status['duration']
+        self._pgs.update(self._task, advance=1, stats=self._stats())
+
+    def _stats(self):
+        elapsed = max(perf_counter() - self._tic, 1e-9)
+        jobs_rate = self.n_done / elapsed
+        audio_rate = self.audio_seconds / elapsed
+
+        remaining = self.n_total - self.n_skipped - self.n_done
+        eta = timedelta(seconds=round(remaining / jobs_rate)) if jobs_rate else "-:--:--"
+        failed = f", [red]{self.n_failed} failed[/red]" if self.n_failed else ""
+        return f"{jobs_rate:.2f} jobs/s, {audio_rate:.1f} audio-s/s, ETA {eta}{failed}"
+
+
 def print_config(config: DictConfig, resolve: bool = True):
     """
     Prints content of DictConfig using Rich library and its tree structure.
@@ -57,9 +120,10 @@ def print_config(config: DictConfig, resolve: bool = True):
         rich.print(tree, file=fp)
 
 
-def create_input_generator(audio_files, dataset: SMIRDataset, resume=True):
+def create_input_generator(audio_files, dataset: SMIRDataset, ledger: JobLedger = None, on_skip=None):
     """
-    Creates an input generator for feature extraction
+    Creates an input generator for feature extraction, grouping scenarios by
+    anechoic audio file so that each file is loaded and transformed only once
 
     Parameters
     ----------
@@ -67,22 +131,363 @@ def create_input_generator(audio_files, dataset: SMIRDataset, resume=True):
         List of anechoic audio files for emulation
     dataset : SMIRDataset
         Dataset class representing spherical microphone impulse responses
-    resume : bool, optional
-        Resume only for the unextracted scenarios, by default True
-    verbose : bool, optional
-        Print metadata, by default True
+    ledger : JobLedger, optional
+        Completed jobs to resume from, all jobs are run if not given
+    on_skip : Callable[[int], None], optional
+        Called with the number of already extracted scenarios of each audio file
+
+    Yields
+    ------
+    Generator[PathLike, List[Dict]]
+        Input anechoic file path and list of its scenarios to be extracted
+    """
+    scenarios = [sc for _, sc in dataset.metadata.iterrows()]
+
+    for fpath in audio_files:
+        pending = ledger.pending(fpath, scenarios) if ledger is not None else scenarios
+
+        if on_skip and len(pending) < len(scenarios):
+            on_skip(len(scenarios) - len(pending))
+        if pending:
+            yield fpath, pending
+
+
+def split_inputs(inputs, n_tasks: int, n_files: int, min_size: int = 1):
+    """
+    Splits the scenarios of each anechoic file into chunks as the files come, so
+    that there are at least `n_tasks` chunks to run in parallel even with few,
+    long files, while scenarios of a chunk still share the decoded file
+
+    Parameters
+    ----------
+    inputs : Iterable[Tuple[PathLike, List[Dict]]]
+        Anechoic file paths and their scenarios, see `create_input_generator`
+    n_tasks : int
+        Minimum number of chunks, e.g. the number of workers
+    n_files : int
+        Number of anechoic files in `inputs`
+    min_size : int, optional
+        Fewest scenarios of a chunk, except for the last one of a file, so that
+        the decode and FFT of the file are shared by at least as many, by default 1
 
     Yields
     ------
-    Generator[PathLike, Dict]
-        Input anechoic file path and dictionary containing scenario metadata
+    Tuple[PathLike, List[Dict]]
+        Anechoic file path and a chunk of its scenarios
+    """
+    n_chunks = -(-n_tasks // max(n_files, 1))  # per file
+
+    for fpath, scenarios in inputs:
+        size = max(min_size, -(-len(scenarios) // n_chunks), 1)
+        for i in range(0, len(scenarios), size):
+            yield fpath, scenarios[i:i + size]
+
+
+def configure_cache(cache_dir=None, operator_banks=None, index_cache_dir=None):
+    """
+    Sets where the operators computed on the fly are cached, by default in the
+    package directory unless operator banks are given, in which case nothing is
+    cached so that the package directory can be read-only, and where dataset
+    indices are cached, by default in ~/.cache/sma_processing either way
+
+    Parameters
+    ----------
+    cache_dir : PathLike, optional
+        Cache directory, relative to the original working directory
+    operator_banks : PathLike, optional
+        Directory of operator banks, see `features.operators`
+    index_cache_dir : PathLike, optional
+        Cache directory of dataset indices, relative to the original working directory
+    """
+    from hydra.utils import to_absolute_path
+
+    from dataset.smir import set_index_cache_dir
+    from features.utils import set_cache_dir
+
+    if cache_dir is not None:
+        set_cache_dir(to_absolute_path(cache_dir))
+    elif operator_banks is not None:
+        set_cache_dir(None)
+
+    if index_cache_dir is not None:
+        set_index_cache_dir(to_absolute_path(index_cache_dir))
+
+
+def create_ir_cache(ir_cache_mb: int, ir_trim: DictConfig = None):
+    """
+    Creates an impulse response cache
+
+    Parameters
+    ----------
+    ir_cache_mb : int
+        Memory budget of the cache
+    ir_trim : DictConfig, optional
+        Truncation of impulse responses with keys `db` (threshold, no truncation
+        if null) and `kind`, see `utils.acoustics.truncation_point`
+    """
+    from dataset.utils import IRCache
+
+    ir_trim = ir_trim or {}
+    return IRCache(max_bytes=ir_cache_mb * 2**20,
+                   trim_db=ir_trim.get('db'), trim_kind=ir_trim.get('kind', 'energy'))
+
+
+def truncation_report(params: DictConfig, dataset: SMIRDataset, audio_files, thresholds_db, kind='energy'):
+    """
+    Compares RENT of scenarios emulated with truncated impulse responses to that
+    with the full ones, to choose a truncation threshold
+
+    Parameters
+    ----------
+    params : DictConfig
+        Parameters for feature extraction
+    dataset : SMIRDataset
+        Dataset class representing spherical microphone impulse responses
+    audio_files : List[Path]
+        Anechoic audio files to emulate
+    thresholds_db : List[float]
+        Truncation thresholds to compare
+    kind : str, optional
+        Truncation criterion, see `utils.acoustics.truncation_point`
+
+    Returns
+    -------
+    pd.DataFrame
+        For each threshold, audio file and scenario: the taps kept, the residual
+        energy of the truncated tails, and the maximum and mean absolute, and the
+        relative (L2) differences of RENT
+    """
+    import numpy as np
+    import pandas as pd
+
+    from dataset.utils import IRCache, Source
+    from extractor import Extractor
+
+    scenarios = [sc for _, sc in dataset.metadata.iterrows()]
+    reference = Extractor(params, dataset, IRCache())
+    truncated = {db: Extractor(params, dataset, IRCache(trim_db=db, trim_kind=kind))
+                 for db in thresholds_db}
+
+    rows = []
+    for fpath in audio_files:
+        source = Source.from_file(fpath)
+        R_refs = reference.iter_jobs(fpath, scenarios, save=False, source=source)
+
+        for sc, R_ref in zip(scenarios, R_refs):
+            ir_paths = dataset.generate_ir_paths(**sc)
+            for db, extractor in truncated.items():
+                R = next(extractor.iter_jobs(fpath, [sc], save=False, source=source))
+                trunc = extractor.ir_cache.truncation(ir_paths)
+                diff = np.abs(R - R_ref)
+                rows.append(dict(
+                    threshold_db=db, audio=fpath.stem, **sc,
+                    taps=trunc['trimmed'] / trunc['n_taps'], residual_db=trunc['residual_db'],
+                    max_diff=diff.max(), mean_diff=diff.mean(),
+                    rel_diff=np.linalg.norm(R - R_ref) / np.linalg.norm(R_ref)))
+
+    return pd.DataFrame(rows)
+
+
+def sh_domain_report(params: DictConfig, dataset: SMIRDataset, audio_files, anm_p99=0.15, rent_p99=0.02):
+    """
+    Compares SHD and RENT of scenarios emulated with SH-domain impulse responses
+    (the `sh_domain` param) to those of the capsule path, to check that they
+    agree within tolerance
+
+    Parameters
+    ----------
+    params : DictConfig
+        Parameters for feature extraction
+    dataset : SMIRDataset
+        Dataset class representing spherical microphone impulse responses
+    audio_files : List[Path]
+        Anechoic audio files to emulate
+    anm_p99 : float, optional
+        Tolerance of the 99th percentile of the relative SHD error of TF bins
+        within 60 dB of the loudest one, by default 0.15
+    rent_p99 : float, optional
+        Tolerance of the 99th percentile of the absolute RENT difference, by
+        default 0.02
+
+    Returns
+    -------
+    pd.DataFrame
+        For each audio file and scenario: the median and 99th percentile of the
+        relative SHD error and of the absolute RENT difference, the maximum RENT
+        difference, and whether both percentiles are within tolerance
+    """
+    import numpy as np
+    import pandas as pd
+
+    from dataset.utils import IRCache, Source
+    from extractor import Extractor
+    from features import rent, shd, srf
+    from microphone import microphones
+
+    scenarios = [sc for _, sc in dataset.metadata.iterrows()]
+    ir_cache = IRCache()
+    extractors = {}
+    for sh_domain in (False, True):
+        p = params.copy()
+        with open_dict(p):
+            p.sh_domain = sh_domain
+        extractors[sh_domain] = Extractor(p, dataset, ir_cache)
+    p = extractors[False].params
+
+    def features(sh_domain, source, sc):
+        y = extractors[sh_domain].load_signal(source, sc)
+        Anm = shd.extract(y, p.fs, p.n_fft, p.olap, p.n_shd, p.fimin, p.fimax, p.j_nu,
+                          microphones[sc['mic']], encoded=sh_domain)
+        R = rent.extract(srf.extract(Anm, p.n_pix), p.n_shd, p.fimin, p.fimax, p.j_nu)
+        return Anm, R
+
+    rows = []
+    for fpath in audio_files:
+        source = Source.from_file(fpath)
+        for sc in scenarios:
+            Anm_ref, R_ref = features(False, source, sc)
+            Anm, R = features(True, source, sc)
+
+            norms = np.linalg.norm(Anm_ref, axis=0)
+            loud = norms >= 1e-3 * norms.max()
+            anm_err = np.linalg.norm(Anm - Anm_ref, axis=0)[loud] / norms[loud]
+            diff = np.abs(R - R_ref)
+            rows.append(dict(
+                audio=fpath.stem, **sc,
+                anm_p50=np.median(anm_err), anm_p99=np.percentile(anm_err, 99),
+                rent_p50=np.median(diff), rent_p99=np.percentile(diff, 99), rent_max=diff.max()))
+
+    report = pd.DataFrame(rows)
+    report['passed'] = (report['anm_p99'] <= anm_p99) & (report['rent_p99'] <= rent_p99)
+    return report
+
+
+# Extractor of a pool worker, see `init_worker`
+_worker = {}
+
+
+def limit_blas_threads(n_threads: int):
+    """
+    Caps the number of threads used by BLAS/OpenMP in this process, so that
+    parallel workers do not oversubscribe the cores
+
+    Environment variables only affect libraries loaded afterwards (e.g. in
+    spawned workers), so `threadpoolctl` is used as well if it is available.
+    """
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']:
+        os.environ[var] = str(n_threads)
+
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return None
+    return threadpool_limits(limits=n_threads)
+
+
+def init_worker(params: DictConfig, dataset_name: str, dataset_path, ir_cache_mb: int, blas_threads: int = 1,
+                store: FeatureStore = None, operator_banks=None, shared_operators=None, ir_trim=None,
+                events=None, dataset_index=None):
+    """
+    Initialises a pool worker with its own extractor, so that neither the
+    extractor nor the dataset needs to be pickled along with every task
+
+    Parameters
+    ----------
+    params : DictConfig
+        Parameters for feature extraction
+    dataset_name : str
+        Name of the dataset in `smir_datasets`
+    dataset_path : PathLike
+        Path of the dataset
+    ir_cache_mb : int
+        Memory budget of the worker's impulse response cache
+    blas_threads : int, optional
+        Number of BLAS threads of the worker, by default 1
+    store : FeatureStore, optional
+        Store the worker saves its results to, in its own shard
+    operator_banks : PathLike, optional
+        Directory of operator banks, memory-mapped and so shared among workers
+    shared_operators : Dict, optional
+        Spec of operators shared by the parent, see `features.operators.SharedOperators`
+    ir_trim : DictConfig, optional
+        Truncation of impulse responses, see `create_ir_cache`
+    events : multiprocessing.Queue, optional
+        Queue the status of each job is put on as soon as it is done, see `run_task`
+    dataset_index : Tuple[List[Path], pd.DataFrame], optional
+        Index of the dataset built by the parent, see `SMIRDataset.index`, so that
+        workers do not list or stamp the dataset again
+    """
+    from dataset import smir_datasets
+    from extractor import Extractor
+    from features.operators import attach_operators
+
+    _worker['limits'] = limit_blas_threads(blas_threads)
+    _worker['events'] = events
+
+    dataset = smir_datasets[dataset_name](dataset_path, dataset_index)
+    _worker['extractor'] = Extractor(
+        params, dataset, create_ir_cache(ir_cache_mb, ir_trim), store, operator_banks)
+    if shared_operators:
+        _worker['extractor'].operators.update(attach_operators(shared_operators))
+
+
+def run_task(task):
+    """
+    Runs extraction jobs of an anechoic file over a chunk of its scenarios in a
+    pool worker, see `split_inputs`
+
+    The status of each job is put on the event queue of the worker, if any, as
+    soon as the job is done, so that progress and completed jobs are reported
+    per job, even if the worker crashes later on.
+
+    A failing scenario is reported as such and the rest of the chunk still runs,
+    only an anechoic file that cannot be read fails all of its scenarios.
+
+    Parameters
+    ----------
+    task : Tuple[PathLike, List[Dict], bool]
+        Anechoic file path, the chunk of its scenarios and whether to save the results
+
+    Returns
+    -------
+    List[Dict]
+        Status of each scenario, with keys: audio, scenario, ok, error, elapsed
+        (seconds spent) and duration (seconds of audio extracted)
     """
-    save_folder = Path.cwd()  # hydra changes cwd
-    scenarios = dataset.metadata.iterrows()
+    from dataset.utils import Source
+
+    fpath, scenarios, save = task
+    extractor = _worker['extractor']
+    events = _worker.get('events')
+
+    statuses = []
 
-    for fpath, (_, sc) in product(audio_files, scenarios):
-        save_name = f"{sc['mic_pos']}_{sc['src_pos']}_{sc['src_dir']}__{fpath.stem}.npy"
-        if not (resume and (save_folder / save_name).exists()):
-            yield fpath, sc
+    def emit(scenario, error=None, duration=0.):
+        status = dict(audio=str(fpath), scenario=dict(scenario), ok=error is None,
+                      error=error, elapsed=perf_counter() - tic, duration=duration)
+        statuses.append(status)
+        if events is not None:
+            events.put(status)
+
+    tic = perf_counter()
+    try:
+        source = Source.from_file(fpath)
+    except Exception as e:
+        for sc in scenarios:
+            emit(sc, error=repr(e))  # none of them can run
+        return statuses
+    duration = len(source) / extractor.params['fs']
+
+    # Errors are caught per scenario, so that the rest of the chunk still runs
+    for sc in scenarios:
+        try:
+            for _ in extractor.iter_jobs(fpath, [sc], save=save, source=source):
+                pass
+        except Exception as e:
+            emit(sc, error=repr(e))
         else:
-            continue
+            emit(sc, duration=duration)
+        tic = perf_counter()
+
+    return statuses
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from omegaconf import DictConfig, OmegaConf
+
+
+def params_hash(*configs: DictConfig) -> str:
+    """
+    Hash of resolved configurations, identifying the parameters of extraction jobs
+
+    Parameters
+    ----------
+    *configs : DictConfig
+        Configurations the results depend on, e.g. extraction parameters and dataset
+
+    Returns
+    -------
+    str
+        Short hexadecimal digest, stable across runs and processes
+    """
+    resolved = [OmegaConf.to_container(c, resolve=True) for c in configs]
+    dump = json.dumps(resolved, sort_keys=True, default=str)
+    return hashlib.sha1(dump.encode()).hexdigest()[:16]
+
+
+class JobLedger:
+    def __init__(self, path, params_id: str) -> None:
+        """
+        Append-only JSON lines record of completed extraction jobs
+
+        A job is identified by its anechoic file, its scenario and the hash of the
+        parameters it was extracted with, so that changing parameters does not
+        reuse stale results. Completed jobs are read once, and resuming queries
+        them in memory instead of checking the output files one by one.
+
+        Parameters
+        ----------
+        path : PathLike
+            Ledger file, created on the first record
+        params_id : str
+            Identifier of the extraction parameters, see `params_hash`
+        """
+        self.path = Path(path)
+        self.params_id = params_id
+        self._file = None
+        self._torn = False  # whether the last line is incomplete
+        self._completed = self._load()
+
+    def __len__(self):
+        return len(self._completed)
+
+    def __contains__(self, job):
+        return self.job_key(*job) in self._completed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def job_key(audio, scenario):
+        # abspath does not touch the filesystem, unlike resolve
+        return os.path.abspath(audio), json.dumps(dict(scenario), sort_keys=True, default=str)
+
+    @classmethod
+    def job_id(cls, audio, scenario):
+        """
+        Short digest of the key of a job, e.g. to identify its stored results
+        """
+        return hashlib.sha1("\t".join(cls.job_key(audio, scenario)).encode()).hexdigest()[:16]
+
+    def pending(self, audio, scenarios):
+        """
+        Scenarios of an anechoic file that are not completed with these parameters
+        """
+        return [sc for sc in scenarios if self.job_key(audio, sc) not in self._completed]
+
+    def record(self, audio, scenario, **info):
+        """
+        Marks a job as completed, the record is flushed to disk immediately so
+        that a crashed run resumes from its last completed job
+
+        Parameters
+        ----------
+        audio : PathLike
+            Anechoic file of the job
+        scenario : Dict
+            Scenario of the job
+        **info
+            Additional fields to record, e.g. elapsed time
+        """
+        key = self.job_key(audio, scenario)
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, 'a')
+            if self._torn:
+                self._file.write("\n")
+
+        line = dict(audio=key[0], scenario=json.loads(key[1]), params=self.params_id, **info)
+        self._file.write(json.dumps(line, default=str) + "\n")
+        self._file.flush()
+        self._completed.add(key)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _load(self):
+        completed = set()
+        if not self.path.exists():
+            return completed
+
+        with open(self.path) as f:
+            for line in f:
+                self._torn = not line.endswith("\n")
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # last line of a crashed run
+                if rec.get('params') == self.params_id:
+                    completed.add(self.job_key(rec['audio'], rec['scenario']))
+        return completed
@@ -1,3 +1,5 @@
+import json
+from itertools import islice
 from pathlib import Path
 
 import numpy as np
@@ -20,13 +22,62 @@ def list_feature_files(output_path="./outputs", job="extract.legendre_count", su
     return file_list
 
 
-def load_feature(file_path, fimin, fimax, j_nu):
+def load_feature(file_path, fimin, fimax, j_nu, mmap_mode=None):
     """ 
     Loads TF-domain feature from a file, discarding empty frequencies
+
+    The frequency offset of the feature is read from its .json sidecar, if any,
+    otherwise the feature is taken to cover the full frequency axis.
+    With `mmap_mode`, a memory-mapped view is returned and nothing is read yet.
+    """
+
+    sidecar = Path(file_path).with_suffix('.json')
+    fi_offset = 0
+    if sidecar.exists():
+        with open(sidecar) as f:
+            fi_offset = json.load(f)['fi_offset']
+
+    return band_limit(np.load(file_path, mmap_mode=mmap_mode), fimin, fimax, j_nu, fi_offset)
+
+
+def band_limit(feature, fimin, fimax, j_nu, fi_offset=0):
+    """ 
+    Keeps frequency indices fimin..fimax+j_nu of a TF-domain feature whose first
+    column is frequency index `fi_offset`, e.g. fimin for band-limited features
+    """
+
+    start, stop = fimin - fi_offset, fimax + j_nu - fi_offset
+    assert 0 <= start and stop <= feature.shape[1], \
+        f"Feature covers frequency indices {fi_offset}..{fi_offset + feature.shape[1]}, not {fimin}..{fimax + j_nu}"
+    return feature[:, start:stop]
+
+
+def load_feature_store(store_path, fimin, fimax, j_nu, query=None, params=None):
+    """ 
+    Loads features and their metadata from a consolidated feature store
+
+    Metadata can be filtered with a pandas query string, e.g. "mic_pos == 'OA-09'".
+    Features extracted with several parameters are told apart by `params`, their
+    identifier (see `utils.ledger.params_hash`), which must then be given.
+    Returns the metadata DataFrame and the list of its features, as memory-mapped
+    views. Features without a recorded frequency offset are taken to cover the
+    full frequency axis.
     """
+    from utils.store import FeatureStore
 
-    feature = np.load(file_path)
-    return feature[:, fimin:fimax+j_nu]
+    store = FeatureStore(store_path, mode='r')
+    index = store.index
+    if params is not None:
+        index = index[index['params'] == params]
+    elif 'params' in index:
+        ids = list(index['params'].dropna().unique())
+        assert len(ids) <= 1, f"Store at {store_path} holds features of parameters {ids}, choose one with `params`"
+    if query is not None:
+        index = index.query(query)
+    offsets = index['fi_offset'].fillna(0) if 'fi_offset' in index else pd.Series(0, index.index)
+    features = [band_limit(store.read(i), fimin, fimax, j_nu, int(offsets[i])) for i in index.index]
+
+    return index, features
 
 
 def parse_metadata(file_path, dataset='spargair', suffix=None):
@@ -67,37 +118,69 @@ def batch_load_metadata(file_list, verbose=True):
     return pd.DataFrame(data)
 
 
-def batch_load_features(file_list, fimin, fimax, j_nu, verbose=True):
+def iter_feature_batches(file_list, fimin, fimax, j_nu, batch_size=64, n_workers=4, prefetch=2):
     """ 
-    Batch loads features given an .npy/npz path list
+    Streams features of an .npy path list in batches
+
+    Files are memory-mapped and only their band-limited frequencies are read, by
+    `n_workers` threads, with at most `prefetch` batches read ahead. Each batch is
+    a (batch_size x ...) array, the last one may be smaller. All features must
+    have the same shape.
     """
-    feature_list = []
-    for i, f_path in enumerate(file_list):
-        if verbose:
-            print(f"{i+1}/{len(file_list)}", end='\r')
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    def read(f_path):
+        return np.array(load_feature(f_path, fimin, fimax, j_nu, mmap_mode='r'))
 
-        feature = load_feature(f_path, fimin, fimax, j_nu)
-        feature_list.append(feature)
+    files = iter(file_list)
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        pending = deque(pool.submit(read, f) for f in islice(files, batch_size * prefetch))
 
-    return np.array(feature_list)
+        while pending:
+            batch = []
+            while pending and len(batch) < batch_size:
+                batch.append(pending.popleft().result())
+                pending.extend(pool.submit(read, f) for f in islice(files, 1))
+            yield np.stack(batch)
 
 
-def batch_load_transform_features(file_list, transformer, fimin, fimax, j_nu, verbose=True):
+def batch_load_features(file_list, fimin, fimax, j_nu, verbose=True, **kwargs):
     """ 
-    Batch loads features and transforms using the function input
-    
-    NOTE: Transformer function is called inside the iteration loop. Note that you may
-    want to use a transforming function that accepts batch input whenever
-    possible, for that probably will be much faster compared to this.
+    Batch loads features given an .npy path list, see `iter_feature_batches` for
+    keyword arguments
+    """
+    features = None
+    i = 0
+    for batch in iter_feature_batches(file_list, fimin, fimax, j_nu, **kwargs):
+        if features is None:
+            features = np.empty((len(file_list),) + batch.shape[1:], dtype=batch.dtype)
+        features[i:i + len(batch)] = batch
+        i += len(batch)
+
+        if verbose:
+            print(f"{i}/{len(file_list)}", end='\r')
+
+    return features if features is not None else np.array([])
+
+
+def batch_load_transform_features(file_list, transformer, fimin, fimax, j_nu, verbose=True, **kwargs):
+    """ 
+    Batch loads features and transforms using the function input, see
+    `iter_feature_batches` for keyword arguments
+
+    NOTE: Transformer function is called with whole batches of features, and
+    returns a sequence of transformed features per batch.
     """
     assert callable(transformer), "'transformer' is not callable"
 
     transformed_features_list = []
-    for i, f_path in enumerate(file_list):
-        if verbose:
-            print(f"{i+1}/{len(file_list)}", end='\r')
+    i = 0
+    for batch in iter_feature_batches(file_list, fimin, fimax, j_nu, **kwargs):
+        transformed_features_list += list(transformer(batch))
+        i += len(batch)
 
-        feature = load_feature(f_path, fimin, fimax, j_nu)
-        transformed_features_list += transformer(feature)
+        if verbose:
+            print(f"{i}/{len(file_list)}", end='\r')
 
     return np.array(transformed_features_list)
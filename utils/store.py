@@ -0,0 +1,215 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+class FeatureStore:
+    def __init__(self, path, dtype=None, params=None, mode='a') -> None:
+        """
+        Append-only store of feature matrices with their metadata
+
+        Features are appended as raw arrays to a data file and indexed by a JSON
+        lines file, with one record per feature holding its metadata, offset and
+        shape. Each process appends to its own shard of the two files, so that
+        parallel workers need no locking, and a feature is indexed only after its
+        data is written. Features are read as memory-mapped views.
+
+        Records also hold the parameters they were extracted with and when they
+        were written, and a job stored again with the same parameters, e.g. when
+        resuming a crashed run, supersedes its earlier records.
+
+        Parameters
+        ----------
+        path : PathLike
+            Directory of the store, created if it does not exist
+        dtype : dtype, optional
+            Data type of the stored features, by default that of an existing store
+            or float64 for a new one
+        params : str, optional
+            Identifier of the extraction parameters recorded with appended
+            features, see `utils.ledger.params_hash`
+        mode : str, optional
+            'a' to append, creating the store if it does not exist, or 'r' to
+            only read an existing store, by default 'a'
+        """
+        assert mode in ('a', 'r'), f"Invalid mode: {mode}"
+        self.path = Path(path)
+        self.params = params
+        self.mode = mode
+        meta_path = self.path / "store.json"
+
+        assert mode != 'r' or meta_path.exists(), f"No feature store at {self.path}"
+        if meta_path.exists():
+            with open(meta_path) as f:
+                meta = json.load(f)
+            assert dtype is None or np.dtype(dtype) == np.dtype(meta['dtype']), \
+                f"Store at {self.path} holds {meta['dtype']} features, not {np.dtype(dtype)}"
+        else:
+            meta = dict(dtype=np.dtype(dtype or 'float64').str, version=1)
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+
+        self.dtype = np.dtype(meta['dtype'])
+        self._data = self._index_file = None
+        self._index = None
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        return self.read(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.read(i)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getstate__(self):
+        # open files and maps are not shared with other processes
+        return dict(path=self.path, dtype=self.dtype, params=self.params, mode=self.mode)
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['dtype'], state['params'], state['mode'])
+
+    def append(self, feature, **metadata):
+        """
+        Appends a feature matrix to the store
+
+        Parameters
+        ----------
+        feature : NDArray
+            Feature to be stored, cast to the dtype of the store
+        **metadata
+            Metadata columns of the feature in the index, e.g. scenario and job,
+            the key of the records superseding each other, see `index`
+        """
+        self._open()
+        feature = np.ascontiguousarray(feature, dtype=self.dtype)
+        offset = self._data.seek(0, os.SEEK_END)
+        self._data.write(feature.tobytes())
+        self._data.flush()
+
+        self._record(offset, feature.shape, metadata)
+
+    @contextmanager
+    def writer(self, shape, **metadata):
+        """
+        Reserves a feature matrix in the store, to be written incrementally
+
+        The feature is indexed only once the block exits without an exception,
+        otherwise its data is left unreferenced as that of a crashed append.
+
+        Parameters
+        ----------
+        shape : Tuple[int]
+            Shape of the feature
+        **metadata
+            Metadata columns of the feature in the index, e.g. scenario and job
+
+        Yields
+        ------
+        NDArray
+            Writable memory-mapped feature of the dtype of the store
+        """
+        self._open()
+        shape = tuple(int(n) for n in shape)
+        offset = self._data.seek(0, os.SEEK_END)
+        nbytes = int(np.prod(shape)) * self.dtype.itemsize
+        self._data.truncate(offset + nbytes)
+
+        if nbytes:
+            feature = np.memmap(self.path / f"{self._shard}.bin", dtype=self.dtype, mode='r+',
+                                offset=offset, shape=shape)
+        else:
+            feature = np.empty(shape, dtype=self.dtype)
+        yield feature
+
+        if nbytes:
+            feature.flush()
+        self._record(offset, shape, metadata)
+
+    def _open(self):
+        assert self.mode != 'r', f"Feature store at {self.path} is opened read-only"
+        if self._data is not None:
+            return
+
+        shard = f"part-{os.getpid()}"
+        self._shard = shard
+        self._data = open(self.path / f"{shard}.bin", 'ab')
+        self._index_file = open(self.path / f"{shard}.jsonl", 'a+')
+        if self._index_file.tell():
+            self._index_file.seek(self._index_file.tell() - 1)
+            if self._index_file.read(1) != "\n":
+                self._index_file.write("\n")  # torn by a crash
+
+    def _record(self, offset, shape, metadata):
+        record = dict(metadata, params=self.params, written=time.time(),
+                      shard=self._shard, offset=offset, shape=list(shape))
+        self._index_file.write(json.dumps(record, default=str) + "\n")
+        self._index_file.flush()
+        self._index = None
+
+    @property
+    def index(self):
+        """
+        Metadata of all stored features as a DataFrame, along with their
+        parameters, shard, offset and shape
+
+        Only the last written record of each job is kept per parameters, records
+        without a job are all kept.
+        """
+        if self._index is None:
+            records = []
+            for index_path in sorted(self.path.glob("part-*.jsonl")):
+                with open(index_path) as f:
+                    for line in f:
+                        try:
+                            records.append(json.loads(line))
+                        except json.JSONDecodeError:
+                            pass  # torn by a crash, its data is not referenced
+            index = pd.DataFrame(records)
+            if 'job' in index:
+                keyed = index['job'].notna()
+                latest = index[keyed].sort_values('written', kind='stable') \
+                    .drop_duplicates([c for c in ('job', 'params') if c in index], keep='last')
+                index = pd.concat([index[~keyed], latest]).sort_index().reset_index(drop=True)
+            self._index = index
+            self._maps = {}  # shards may have grown
+        return self._index
+
+    def read(self, i):
+        """
+        Reads a feature as a read-only memory-mapped view
+
+        Parameters
+        ----------
+        i : int
+            Position of the feature in `index`
+        """
+        rec = self.index.iloc[i]
+        if rec['shard'] not in self._maps:
+            self._maps[rec['shard']] = np.memmap(
+                self.path / f"{rec['shard']}.bin", dtype=self.dtype, mode='r')
+
+        start = rec['offset'] // self.dtype.itemsize
+        size = int(np.prod(rec['shape']))
+        return self._maps[rec['shard']][start:start + size].reshape(rec['shape'])
+
+    def close(self):
+        for f in (self._data, self._index_file):
+            if f is not None:
+                f.close()
+        self._data = self._index_file = None
+        self._maps = {}
@@ -0,0 +1,178 @@
+import os
+import struct
+
+import numpy as np
+
+# WAVE format tags
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def wav_info(path):
+    """
+    Parses the header of a WAVE file, without reading its samples
+
+    Parameters
+    ----------
+    path: str, PathLike or open binary file handle
+        WAVE file, handles are read from their current position and left there
+
+    Returns
+    -------
+    dict
+        fs (sample rate), n_channels, n_samples, bits (per sample), kind ('i' for
+        integer or 'f' for float samples), offset (of the first sample in bytes)
+        and block_align (bytes per sample frame)
+    """
+    if isinstance(path, (str, bytes, os.PathLike)):
+        with open(path, 'rb') as f:
+            return wav_info(f)
+
+    pos = path.tell()
+    try:
+        return _parse_header(path)
+    finally:
+        path.seek(pos)
+
+
+def _parse_header(f):
+    riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+    assert riff == b'RIFF' and wave == b'WAVE', "Not a RIFF/WAVE file"
+
+    info = None
+    while True:
+        header = f.read(8)
+        assert len(header) == 8, "No data chunk in the WAVE file"
+        chunk_id, size = struct.unpack('<4sI', header)
+
+        if chunk_id == b'fmt ':
+            fmt = f.read(size)
+            tag, n_channels, fs, _, block_align, bits = struct.unpack('<HHIIHH', fmt[:16])
+            if tag == WAVE_FORMAT_EXTENSIBLE:
+                tag = struct.unpack('<H', fmt[24:26])[0]  # first bytes of the subformat GUID
+            assert tag in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT), f"Unsupported WAVE format: {tag:#x}"
+
+            kind = 'f' if tag == WAVE_FORMAT_IEEE_FLOAT else 'i'
+            assert (kind, bits) in (('i', 16), ('i', 24), ('i', 32), ('f', 32), ('f', 64)), \
+                f"Unsupported sample format: {bits}-bit {'float' if kind == 'f' else 'integer'}"
+            info = dict(fs=fs, n_channels=n_channels, bits=bits, kind=kind, block_align=block_align)
+
+        elif chunk_id == b'data':
+            assert info is not None, "No fmt chunk before the data chunk"
+            info['offset'] = f.tell()
+            info['n_samples'] = size // info['block_align']
+            return info
+
+        else:
+            f.seek(size + size % 2, 1)  # chunks are word aligned
+
+
+def read_wav(path, start=0, stop=None, dtype=np.float64, mmap=True, out=None):
+    """
+    Reads a range of samples of a WAVE file into an ndarray
+
+    Integer samples are scaled by 1 / (2^(bits - 1) + 1), float samples are kept
+    as they are.
+
+    Parameters
+    ----------
+    path: str, PathLike or open binary file handle
+        WAVE file, handles are read from their current position and left there
+    start, stop: int, optional
+        Range of samples to read, by default all
+    dtype: dtype, optional
+        Data type of the output, by default float64
+    mmap: bool, optional
+        Whether to read through a memory map, so that only the range is touched.
+        Ignored for file handles.
+    out: ndarray, optional
+        (n_samples x n_channels) array to read into, squeezed for single-channel files
+
+    Returns
+    -------
+    sig: ndarray
+        (n_samples x n_channels) samples, or (n_samples) if single-channel
+    fs: int
+        Sample rate of the WAVE file
+    """
+    info = wav_info(path)
+    stop = info['n_samples'] if stop is None else min(stop, info['n_samples'])
+    start = min(start, stop)
+    n_channels, n_samples = info['n_channels'], stop - start
+
+    raw = _read_raw(path, info, start, n_samples, mmap)
+    if info['kind'] == 'i' and info['bits'] == 24:
+        raw = _int24_to_int32(raw)
+
+    shape = (n_samples, n_channels) if n_channels > 1 else (n_samples,)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    raw = raw.reshape(shape)
+
+    if info['kind'] == 'i':
+        np.divide(raw, float(2 ** (info['bits'] - 1)) + 1, out=out, casting='unsafe')
+    else:
+        out[...] = raw
+    return out, info['fs']
+
+
+def read_channels(paths, start=0, stop=None, dtype=np.float64, mmap=True):
+    """
+    Reads several single-channel WAVE files, e.g. the channels of an impulse
+    response, into one preallocated (n_channels x n_samples) array
+
+    Files shorter than the longest one are zero-padded.
+
+    Parameters
+    ----------
+    paths: List[str or PathLike]
+        Single-channel WAVE files, one per channel
+    start, stop, dtype, mmap:
+        See `read_wav`
+
+    Returns
+    -------
+    ndarray
+        (n_channels x n_samples) samples
+    """
+    infos = [wav_info(p) for p in paths]
+    assert all(info['n_channels'] == 1 for info in infos), "Expected single-channel files"
+
+    n_samples = max(info['n_samples'] for info in infos) if infos else 0
+    stop = n_samples if stop is None else min(stop, n_samples)
+    sig = np.zeros((len(paths), max(stop - start, 0)), dtype=dtype)
+
+    for ch, (path, info) in enumerate(zip(paths, infos)):
+        n = max(min(stop, info['n_samples']) - start, 0)
+        read_wav(path, start, start + n, dtype, mmap, out=sig[ch, :n])
+    return sig
+
+
+def _read_raw(path, info, start, n_samples, mmap):
+    bytes_per_sample = info['bits'] // 8
+    if info['kind'] == 'f':
+        dtype = np.dtype(f"<f{bytes_per_sample}")
+    elif bytes_per_sample == 3:
+        dtype = np.dtype('u1')  # assembled into int32 by the caller
+    else:
+        dtype = np.dtype(f"<i{bytes_per_sample}")
+
+    count = n_samples * info['n_channels'] * (3 if bytes_per_sample == 3 else 1)
+    offset = info['offset'] + start * info['block_align']
+
+    if not isinstance(path, (str, bytes, os.PathLike)):
+        pos = path.tell()
+        path.seek(offset)
+        raw = np.frombuffer(path.read(count * dtype.itemsize), dtype=dtype)
+        path.seek(pos)  # as wav_info, so that the handle can be read again
+        return raw
+    if mmap and count:
+        return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+    return np.fromfile(path, dtype=dtype, count=count, offset=offset)
+
+
+def _int24_to_int32(raw):
+    b = raw.reshape(-1, 3).astype(np.int32)
+    x = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+    return (x << 8) >> 8  # sign extension